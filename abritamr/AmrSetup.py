@@ -1,6 +1,26 @@
-import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections
+import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections, re
+from concurrent.futures import ThreadPoolExecutor
 from abritamr.version import db
-from abritamr.CustomLog import CustomFormatter
+from abritamr.CustomLog import get_logger
+from abritamr.Compression import compression, open_contigs, READ_ERRORS
+
+
+FastaStats = collections.namedtuple('FastaStats', ['bases', 'contigs'])
+
+
+def fasta_stats(path):
+    """
+    total length and number of contigs in a (possibly compressed) fasta file, from a single streaming pass
+    """
+    bases = 0
+    contigs = 0
+    with open_contigs(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                contigs += 1
+            else:
+                bases += len(line.rstrip())
+    return FastaStats(bases, contigs)
 
 
 class Setup(object):
@@ -10,17 +30,7 @@ class Setup(object):
     def __init__(self, args):
         
 
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         
         
     def file_present(self, name):
@@ -32,7 +42,7 @@ class Setup(object):
         if name == "":
             return False
         elif pathlib.Path(name).exists():
-            self.logger.info(f"Checking if file {name} exists")
+            self.logger.debug(f"Checking if file {name} exists")
             return True
         else:
             return False
@@ -42,23 +52,17 @@ class SetupAMR(Setup):
     """
     setup amr inputs for amrfinder run
     """
+    SNIFF_BYTES = 4096
+    CHECK_WORKERS = 16
+    SHARD_SHEET = "abritamr_shard.tsv"
+
     def __init__(self, args):
         
 
         # for amr
         self.species_list = ["Burkholderia_cepacia","Acinetobacter_baumannii","Streptococcus_pyogenes","Streptococcus_agalactiae","Streptococcus_pneumoniae","Enterococcus_faecium","Pseudomonas_aeruginosa","Staphylococcus_pseudintermedius","Clostridioides_difficile","Klebsiella","Neisseria","Campylobacter","Salmonella","Escherichia","Staphylococcus_aureus","Burkholderia_pseudomallei","Enterococcus_faecalis"]
         
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
 
         
         self.jobs = args.jobs # number of amrfinderplus to run at a time
@@ -69,6 +73,16 @@ class SetupAMR(Setup):
         self.species = args.species if args.species in self.species_list else ""
         self.identity = args.identity
         self.amrfinder_db = args.amrfinder_db
+        self.engine = args.engine
+        self.resume = args.resume
+        self.cache = args.cache
+        self.cache_size = args.cache_size
+        self.shard = args.shard
+        self.chunks = args.chunks
+        self.pack_size = args.pack_size
+        self.stage_db = args.stage_db
+        self.tmpdir = args.tmpdir
+        self.retries = args.retries
 
         
 
@@ -85,23 +99,59 @@ class SetupAMR(Setup):
 
             
     
+    def _batch_rows(self):
+        """
+        yield the rows of a batch input one at a time, stopping at the first row that is not two tab delimited columns
+        """
+        with open(self.contigs, 'r') as c:
+            for line in c:
+                line = line.rstrip('\n')
+                if line.strip() == '':
+                    continue
+                row = line.split('\t')
+                if len(row) != 2:
+                    self.logger.critical("Your input file should either be a tab delimited file with two columns or the path to contigs. Please check your input and try again.")
+                    raise SystemExit
+                yield row
+
     def _get_input_shape(self):
         """
-        determine shape of file
+        determine shape of file - only the start of the file is read to tell contigs from a batch file
         """
         run_type = 'assembly'
-        with open(self.contigs, 'r') as c:
-            data = c.read().strip().split('\n')
-            firstline = data[0]
-            if not firstline.startswith('>'):
-                for line in data:
-                    if len(line.split('\t')) != 2:
-                        self.logger.critical("Your input file should either be a tab delimited file with two columns or the path to contigs. Please check your input and try again.")
-                        raise SystemExit
-                run_type = 'batch'
+        with open_contigs(self.contigs) as c:
+            head = c.read(self.SNIFF_BYTES)
+        if not head.lstrip().startswith(b'>'):
+            for row in self._batch_rows():
+                pass
+            run_type = 'batch'
         self.logger.info(f"The input file seems to be in the correct format. Thank you.")
         return run_type
-    
+
+    def _check_assembly(self, path):
+        """
+        return the size of an assembly, or None if it is missing. A compressed assembly that can not be read to the end stops the run.
+        """
+        if path == '' or not pathlib.Path(path).exists():
+            return None
+        try:
+            return fasta_stats(path)
+        except READ_ERRORS as e:
+            self.logger.critical(f"{path} could not be read, it may be truncated or corrupt ({e}). Please check your input and try again.")
+            raise SystemExit
+
+    def _check_compression(self, paths, pool = None):
+        """
+        report compressed assemblies - they are decompressed for each job by the native engine
+        """
+        kinds = collections.Counter(pool.map(compression, paths) if pool is not None else map(compression, paths))
+        kinds.pop('', None)
+        if kinds:
+            found = ', '.join(f"{n} {k}" for k, n in kinds.items())
+            self.logger.info(f"Compressed assemblies found ({found}), each will be decompressed to a temporary file while amrfinder runs.")
+            if getattr(self, 'engine', 'native') == 'parallel':
+                self.logger.warning(f"Compressed assemblies are passed to amrfinder unchanged by the parallel engine, use the native engine if your version of amrfinder does not read them.")
+        return dict(kinds)
 
     def _input_files(self):
         """
@@ -109,17 +159,27 @@ class SetupAMR(Setup):
         """
         
         running_type = self._get_input_shape()
+        self.sizes = {}
+        self.outdir = ''
         if running_type == 'batch':
             self.logger.info(f"Checking that the input data is present.")
-            with open(self.contigs, 'r') as c:
-                data = c.read().strip().split('\n')
-                for line in data:
-                    row = line.split('\t')
-                    if not self.file_present(row[1]):
+            rows = list(self._batch_rows())
+            if getattr(self, 'shard', ''):
+                # only this shard's assemblies are read, the split itself only needs their sizes on disk
+                self.contigs, self.outdir, rows = self._shard_batch(rows)
+            # assemblies are checked concurrently, slow shared filesystems are dominated by latency rather than bandwidth
+            with ThreadPoolExecutor(max_workers = self.CHECK_WORKERS) as pool:
+                for row, stats in zip(rows, pool.map(self._check_assembly, [row[1] for row in rows])):
+                    if stats is None:
                         self.logger.critical(f"{row[1]} is not a valid file path. Please check your input and try again.")
                         raise SystemExit
+                    self.sizes[row[0]] = stats
+                self._check_compression([row[1] for row in rows], pool = pool)
+            self.logger.info(f"{len(rows)} assemblies are present.")
         elif running_type == 'assembly' and self.file_present(self.contigs):
             self.logger.info(f"{self.contigs} is present. abritamr can proceed.")
+            self.sizes[self.prefix] = self._check_assembly(self.contigs)
+            self._check_compression([self.contigs])
         else:
             self.logger.critical(f"Something has gone wrong with your inputs. Please try again.")
             raise SystemExit
@@ -127,15 +187,90 @@ class SetupAMR(Setup):
         return running_type
    
 
+    def _parse_shard(self):
+        """
+        return (i, N) from a shard given as i/N
+        """
+        m = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', f"{self.shard}")
+        if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            self.logger.critical(f"The shard {self.shard} is not valid, it should be given as i/N where i is between 1 and N (eg 1/4).")
+            raise SystemExit
+        return int(m.group(1)), int(m.group(2))
+
+    def _assign_shards(self, rows, n, sizes):
+        """
+        assign each row of the batch to one of n shards, largest assemblies first to the shard with the fewest bytes so far. Ties are broken on row order so every node computes the same split.
+        """
+        load = [0] * n
+        shards = [None] * len(rows)
+        for r in sorted(range(len(rows)), key = lambda r: (-sizes.get(rows[r][0], 0), r)):
+            s = min(range(n), key = lambda k: (load[k], k))
+            shards[r] = s
+            load[s] += sizes.get(rows[r][0], 0)
+        return shards, load
+
+    def _file_size(self, path):
+        """
+        the size of an assembly on disk, or None if it is missing
+        """
+        try:
+            return os.stat(path).st_size if path != '' else None
+        except OSError:
+            return None
+
+    def _shard_batch(self, rows):
+        """
+        write the rows of the batch that belong to this shard to a sample sheet in the shard output directory and return the sample sheet, directory and rows. Shards are balanced on the size of the assemblies on disk, which is cheap to find and the same on every node.
+        """
+        i, n = self._parse_shard()
+        with ThreadPoolExecutor(max_workers = self.CHECK_WORKERS) as pool:
+            sizes = {}
+            for row, size in zip(rows, pool.map(self._file_size, [row[1] for row in rows])):
+                if size is None:
+                    self.logger.critical(f"{row[1]} is not a valid file path. Please check your input and try again.")
+                    raise SystemExit
+                sizes[row[0]] = size
+        shards, load = self._assign_shards(rows, n, sizes)
+        outdir = f"shard_{i}_of_{n}"
+        pathlib.Path(outdir).mkdir(parents = True, exist_ok = True)
+        sheet = f"{outdir}/{self.SHARD_SHEET}"
+        mine = [row for row, s in zip(rows, shards) if s == i - 1]
+        if mine == []:
+            self.logger.critical(f"There are no samples in shard {i} of {n}, the batch only has {len(rows)} samples.")
+            raise SystemExit
+        with open(sheet, 'w') as f:
+            for row in mine:
+                f.write("\t".join(row) + "\n")
+        self.logger.info(f"This is shard {i} of {n} with {len(mine)} of {len(rows)} samples ({load[i - 1] / 1e6:.1f} Mb on disk). Batch outputs will be saved in {outdir}.")
+        return sheet, outdir, mine
+
     def setup(self):
         # check that inputs are correct and files are present
         running_type = self._input_files()
         # check that prefix is present (if needed)
         if running_type == 'assembly':
             self._check_prefix()
+        outdir = self.outdir
+        if self.shard and running_type != 'batch':
+            self.logger.warning(f"--shard is only used in batch mode and will be ignored.")
+        if not f"{self.chunks}".isdigit() or int(self.chunks) < 1:
+            self.logger.critical(f"--chunks should be a whole number of at least 1, not {self.chunks}.")
+            raise SystemExit
+        try:
+            pack_size = float(self.pack_size)
+        except ValueError:
+            pack_size = -1
+        if pack_size < 0:
+            self.logger.critical(f"--pack_size should be a number of Mb (0 to run each sample on its own), not {self.pack_size}.")
+            raise SystemExit
+        if not f"{self.retries}".isdigit():
+            self.logger.critical(f"--retries should be a whole number, not {self.retries}.")
+            raise SystemExit
+        if int(self.chunks) > 1 and running_type == 'batch':
+            self.logger.warning(f"--chunks is only used for single samples, in batch mode samples are run side by side instead.")
         
-        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db'])
-        input_data = Data(running_type, self.contigs, self.prefix, self.jobs, self.species, self.identity, self.amrfinder_db)
+        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db', 'engine', 'resume', 'cache', 'cache_size', 'sizes', 'outdir', 'chunks', 'pack_size', 'stage_db', 'tmpdir', 'retries'])
+        input_data = Data(running_type, self.contigs, self.prefix, self.jobs, self.species, self.identity, self.amrfinder_db, self.engine, self.resume, self.cache, self.cache_size, self.sizes, outdir, self.chunks, self.pack_size, self.stage_db, self.tmpdir, self.retries)
         
         return input_data
 
@@ -147,17 +282,7 @@ class SetupMDU(Setup):
     def __init__(self, args):
         
 
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.db = db
         self.qc = args.qc
         self.runid = args.runid
@@ -165,6 +290,19 @@ class SetupMDU(Setup):
         self.partials = args.partials   
         self.sop = args.sop
         self.sop_name = args.sop_name
+        self.format = args.format
+
+    def _check_format(self):
+        """
+        check the report format can be written - parquet needs pyarrow
+        """
+        if self.format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                self.logger.critical(f"Parquet reports need pyarrow, please install it (pip install pyarrow) or choose another --format.")
+                raise SystemExit
+        return True
 
     def _check_runid(self):
         if self.runid == '':
@@ -188,7 +326,7 @@ class SetupMDU(Setup):
             # 'summary_partials':self.partials
             }
 
-        if self._check_runid():
+        if self._check_runid() and self._check_format():
             self.logger.info(f"You are generating a {'general report' if self.sop == 'general' else 'species specific report'}")
             self.logger.info(f"Now checking all input files are present.")
             for _file in file_dict:
@@ -199,7 +337,7 @@ class SetupMDU(Setup):
                     self.logger.critical(f"The {_file} file supplied ({file_dict[_file]}) does not exist. Please check your inputs and try again.")
                     raise SystemExit
 
-            Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid', 'sop','sop_name'])
+            Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid', 'sop','sop_name', 'format'])
         
-            return Data(self.qc, self.matches, self.partials, self.db, self.runid, self.sop, self.sop_name)
+            return Data(self.qc, self.matches, self.partials, self.db, self.runid, self.sop, self.sop_name, self.format)
         
\ No newline at end of file
@@ -0,0 +1,156 @@
+import pathlib, os, shutil, tempfile, fcntl, contextlib, hashlib, json, logging
+
+
+def cache_dir():
+    """
+    the directory used for abritamr's on-disk caches
+    """
+    base = os.environ.get("XDG_CACHE_HOME", pathlib.Path.home() / ".cache")
+    return pathlib.Path(base) / "abritamr"
+
+
+class ResultCache(object):
+    """
+    A content-addressed store of amrfinder outputs, keyed on the sha256 of the contigs and everything else that changes the result. Entries are evicted least recently used first once the cache is larger than max_bytes. A lock file makes it safe to share between concurrent abritamr processes.
+    """
+
+    TOTAL = ".size" # the running size of the entries, kept under the lock
+
+    def __init__(self, path, max_bytes):
+        self.logger = logging.getLogger(__name__)
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents = True, exist_ok = True)
+        self.lockfile = self.path / ".lock"
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive = True):
+        with open(self.lockfile, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def key(self, input_sha256, db_version, organism, identity, amrfinder_version):
+        """
+        the cache key for a sample
+        """
+        return hashlib.sha256(json.dumps([input_sha256, db_version, organism, f"{identity}", amrfinder_version]).encode()).hexdigest()
+
+    def _entry(self, key):
+        return self.path / key[:2] / f"{key}.out"
+
+    def get(self, key, dest):
+        """
+        copy a cached result to dest, returns True on a hit
+        """
+        entry = self._entry(key)
+        with self._lock(exclusive = False):
+            if not entry.exists():
+                return False
+            shutil.copyfile(entry, dest)
+            # mark as recently used for eviction
+            os.utime(entry)
+        return True
+
+    def put(self, key, src):
+        """
+        store the result in src under key and evict old entries if the cache is too big
+        """
+        entry = self._entry(key)
+        entry.parent.mkdir(parents = True, exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = entry.parent, suffix = ".tmp")
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        size = os.path.getsize(tmp)
+        with self._lock():
+            try:
+                replaced = entry.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp, entry)
+            # a running total is kept beside the entries so that the cache is only scanned once it is over max_bytes
+            total = self._total()
+            total = sum(e[1] for e in self._entries()) if total is None else total + size - replaced
+            if total > self.max_bytes:
+                total = self._evict()
+            self._write_total(total)
+        return True
+
+    def _total(self):
+        try:
+            return int((self.path / self.TOTAL).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_total(self, total):
+        (self.path / self.TOTAL).write_text(f"{total}")
+
+    def _entries(self):
+        """
+        (mtime, size, path) of every entry, each stat'ed once
+        """
+        entries = []
+        for e in self.path.glob("*/*.out"):
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e))
+        return entries
+
+    def _evict(self):
+        """
+        remove the least recently used entries until the cache fits max_bytes and return the size of what is left - must hold the lock
+        """
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        for _, size, e in sorted(entries, key = lambda x: x[0]):
+            if total <= self.max_bytes:
+                break
+            e.unlink(missing_ok = True)
+            total -= size
+            self.logger.debug(f"Evicted {e.name} from the result cache.")
+        return total
+
+
+def file_key(path):
+    """
+    identify a file by its real path, modification time and size - None if it does not exist
+    """
+    try:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def probe(name, key, compute):
+    """
+    return compute(), remembered in the cache directory under name and key so that external tools are only run again when they change. Nothing is remembered if key is None or the probe gives an empty result.
+    """
+    if key is None:
+        return compute()
+    path = cache_dir() / "probes.json"
+    try:
+        probes = json.loads(path.read_text())
+    except (OSError, ValueError):
+        probes = {}
+    k = f"{name}:{key}"
+    if k in probes:
+        return probes[k]
+    value = compute()
+    if not value:
+        return value
+    probes[k] = value
+    try:
+        path.parent.mkdir(parents = True, exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = path.parent, suffix = ".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(probes, f)
+        os.replace(tmp, path)
+    except OSError:
+        logging.getLogger(__name__).debug(f"Unable to save {name} to {path}.")
+    return value
@@ -1,9 +1,68 @@
 #!/usr/bin/env python3
-import pathlib, pandas, math, sys,  re, logging, numpy
+import pathlib, pandas, math, sys,  re, logging, numpy, io, csv, json, heapq, itertools
 import warnings
 pandas.options.mode.chained_assignment = None
 # from pandas.core.algorithms import isin
-from abritamr.CustomLog import CustomFormatter
+from abritamr.CustomLog import get_logger
+from abritamr.RefGenes import RefGenesIndex, load_refgenes
+from abritamr.Rules import GeneralRules
+from abritamr.Report import ReportWriter
+
+class SummaryWriter(object):
+    """
+    write summary rows to disk as they are produced. Each row is spooled as a line of json next to the output and the union of drug class columns is tracked as rows arrive - the wide table is written in one pass over the spool on close.
+    """
+
+    def __init__(self, path, sort = False):
+        self.path = f"{path}"
+        self.sort = sort
+        self.columns = []
+        self._seen = set()
+        self._keys = [] # (isolate, offset) when the output is sorted
+        self.spool = open(f"{self.path}.spool", 'w+')
+
+    def write(self, record):
+        """
+        spool a single row
+        """
+        for c in record:
+            if c != 'Isolate' and c not in self._seen:
+                self._seen.add(c)
+                self.columns.append(c)
+        if self.sort:
+            self._keys.append((record['Isolate'], self.spool.tell()))
+        self.spool.write(json.dumps(record) + "\n")
+
+    def rows(self):
+        """
+        iterate over the rows spooled so far
+        """
+        self.spool.flush()
+        with open(self.spool.name, 'r') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _sorted_rows(self):
+        self.spool.flush()
+        with open(self.spool.name, 'r') as f:
+            for _, offset in sorted(self._keys, key = lambda k: k[0]):
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def close(self):
+        """
+        write the wide table and remove the spool
+        """
+        rows = self._sorted_rows() if self.sort else self.rows()
+        with open(self.path, 'w', newline = '') as out:
+            writer = csv.writer(out, delimiter = '\t', lineterminator = '\n')
+            writer.writerow(['Isolate'] + self.columns)
+            for row in rows:
+                writer.writerow([row['Isolate']] + [row.get(c, '') for c in self.columns])
+        self.spool.close()
+        pathlib.Path(self.spool.name).unlink()
+        return True
+
 
 class Collate:
 
@@ -14,22 +73,17 @@ class Collate:
     ANNOTATIONS = {'blast':'*','partial':'^','exact':''}
     REFGENES = pathlib.Path(__file__).parent / "db" / "refgenes_latest.csv"
     MATCH = ["ALLELEX", "BLASTX", "EXACTX", "POINTX"]
+    STREAM_BATCH = 20000 # batches larger than this are streamed to disk rather than held in memory
+    STREAM_BLOCK = 2000 # samples collated together when a batch is streamed
+    FAILURES = "abritamr_failures.tsv" # samples that amrfinder failed for, written by RunFinder
+    HIT_COLS = ["Gene symbol", "Element type", "Element subtype", "Method", "Accession of closest sequence"]
 
     def __init__(self, args):
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.prefix = args.prefix
         self.run_type = args.run_type
         self.input = args.input
+        self.outdir = getattr(args, 'outdir', '')
 
     def joins(self, dict_for_joining):
         """
@@ -42,30 +96,31 @@ class Collate:
 
         return dict_for_joining
 
+    def _refindex(self, reftab):
+        """
+        return the lookup index for reftab - built once per table and reused for every hit
+        """
+        if isinstance(reftab, RefGenesIndex):
+            return reftab
+        index = getattr(self, '_refgenes_index', None)
+        if index is None or index.reftab is not reftab:
+            index = RefGenesIndex(reftab)
+            self._refgenes_index = index
+        return index
+
     def get_drugclass(self, reftab, row, colname):
 
         """
         if the enhanced subclass is in either NONRTM or MACROLIDES then then use the groups specified by Norelle. If it is empty (-) then fall back on the AMRFinder subclass, else report the extended subclass
         """
         gene_id_col = "Gene symbol" if colname != "refseq_protein_accession" else "Accession of closest sequence" # to get the name of drug and the drugclass
-        if reftab[reftab[colname] == row[1][gene_id_col]].empty:
-            d = 'Unknown'
-            for i in ['genbank_protein_accession','refseq_nucleotide_accession','genbank_nucleotide_accession']:
-                
-                if not reftab[reftab[i] == row[1][gene_id_col]].empty:
-                    d= reftab[reftab[i] == row[1][gene_id_col]]['enhanced_subclass'].values[0]
-                    break
-        else:
-            
-            d = reftab[reftab[colname] == row[1][gene_id_col]]['enhanced_subclass'].values[0]
-        
-        return d
+        return self._refindex(reftab).drugclass(row[1][gene_id_col], colname)
 
     def extract_bifunctional_name(self, protein, reftab):
         """
         extract the joint name of bifunctional genes
         """
-        return reftab[reftab["refseq_protein_accession"] == protein]["gene_family"].values[0]
+        return self._refindex(reftab).bifunctional_name(protein)
 
     def extract_gene_name(self, protein, reftab, pointn = False):
         
@@ -73,52 +128,18 @@ class Collate:
         # amrfinderplus returns the nucleotide accession with the range for what was detected.. these
         # so extract just the name of accession and set col to work with to nucleotide rather than protein
         # Add POINTN to end so users know this is a different type of match 
-        suff = f"_POINTN" if pointn else ""
-        protein = protein.split(':')[0] if pointn else protein
-        col ="refseq_nucleotide_accession" if pointn else "refseq_protein_accession"
-        
-        try:
-            if reftab[reftab[col] == protein]["allele"].values[0] != '-':
-                nme = f"{reftab[reftab[col] == protein]['allele'].values[0]}{suff}"
-                return nme
-            else:
-                return reftab[reftab[col] == protein]["gene_family"].values[0]
-        except IndexError:
-            for i in ['genbank_protein_accession','refseq_nucleotide_accession','genbank_nucleotide_accession']:
-                if len(reftab[reftab[i] == protein]["gene_family"].unique()) >= 1:
-                    return reftab[reftab[i] == protein]["gene_family"].unique()[0]
+        return self._refindex(reftab).gene_name(protein, pointn = pointn)
             
     def setup_dict(self, drugclass_dict, reftab, row, _type = 'exact', pointn = False):
         """
         return the dictionary for collation
         """
-        if row[1]["Gene symbol"] in list(reftab["allele"]) and 'POINT' not in row[1]['Method']:
-            drugclass = self.get_drugclass(
-                    reftab=reftab, row=row, colname="allele"
-                    )
-            drugname = self.extract_gene_name(protein = row[1]["Accession of closest sequence"], reftab = reftab, pointn = pointn)
-        elif row[1]["Gene symbol"] in list(reftab["allele"]) and 'POINT' in row[1]['Method']:
-            drugclass = self.get_drugclass(
-                    reftab=reftab, row=row, colname="allele"
-                    )
-            drugname = row[1]["Gene symbol"]
-            
-        elif row[1]["Gene symbol"] in list(reftab["gene_family"]):
-            
-            drugclass = self.get_drugclass(
-                reftab=reftab, row=row, colname="refseq_protein_accession"
-            )
-            drugname = f"{self.extract_gene_name(protein = row[1]['Accession of closest sequence'], reftab = reftab)}*" if not row[1]["Method"] in ["EXACTX", "ALLELEX"] else f"{self.extract_gene_name(protein = row[1]['Accession of closest sequence'], reftab = reftab)}"
-            
-        elif row[1]["Accession of closest sequence"] in list(reftab["refseq_protein_accession"]):
-            
-            drugclass = self.get_drugclass(
-                reftab = reftab, row = row, colname = "refseq_protein_accession"
+        drugclass, drugname = self._refindex(reftab).resolve(
+            gene_symbol = row[1]["Gene symbol"],
+            accession = row[1]["Accession of closest sequence"],
+            method = row[1]["Method"],
+            pointn = pointn
             )
-            drugname = self.extract_bifunctional_name(protein = row[1]['Accession of closest sequence'], reftab = reftab)
-        else:
-            drugname = row[1]["Gene symbol"]
-            drugclass = "Unknown"
 
         if drugclass in drugclass_dict:
             drugclass_dict[drugclass].append(drugname)
@@ -141,6 +162,7 @@ class Collate:
         """
         make three dictionaries for each isolate that contain the drug class assignments for each match that is one of ALLELEX,POINTX, EXACTX or BLASTX, another dictionary which lists all partial mathces and a dictionary of virulence factors
         """
+        reftab = self._refindex(reftab)
         drugclass_dict = {"Isolate": isolate}
         partials = {"Isolate": isolate}
         other = {"Isolate": isolate}
@@ -186,7 +208,8 @@ class Collate:
                     df = tmp[['Isolate']]
                 c = t.split('_')[0] # strip the _x or _y for col name
                 if c not in list(df.columns): # if this has not already been added - should never happen but best safe than sorry
-                    df[c] = tmp[[f"{c}_x", f"{c}_y"]].apply(lambda x: ','.join([i for i in x if i != '']), axis = 1) # combine the values and join with a comma
+                    x, y = tmp[f"{c}_x"], tmp[f"{c}_y"]
+                    df[c] = numpy.where((x != '') & (y != ''), x + ',' + y, x + y) # combine the values and join with a comma
             else:
                 # if this is a column that only appears in one df
                 if df.empty:
@@ -239,26 +262,27 @@ class Collate:
         return True
         
 
+    def _get_refindex(self):
+        """
+        get the refgenes lookup index - loaded once per process and shared by all Collate objects
+        """
+        return load_refgenes(self.REFGENES)
+
     def _get_reftab(self):
         """
         get reftab
         """
 
-        reftab = pandas.read_csv(self.REFGENES)
-        reftab = reftab.fillna("-")
-
-        return reftab
+        return self._get_refindex().reftab
 
     def collate(self, prefix = ''):
         """
-        if the refgenes.csv is present then proceed to collate data and save the csv files.
+        collate a single sample row by row - the reference for the vectorised engine used by run
         """
-
-        
-        reftab = self._get_reftab()
+        reftab = self._get_refindex()
         
         df = pandas.read_csv(f"{prefix}/amrfinder.out", sep="\t")
-        self.logger.info(f"Opened amrfinder output for {prefix}")
+        self.logger.debug(f"Opened amrfinder output for {prefix}")
         drug, partial, virulence = self.get_per_isolate(
             reftab=reftab, df=df, isolate=prefix
         )
@@ -267,37 +291,202 @@ class Collate:
         summary_partial = pandas.DataFrame(partial, index = [0])
         summary_virulence = pandas.DataFrame(virulence, index = [0])
         return summary_drugs, summary_partial,summary_virulence
-        
-    
-    def _combine_df(self, existing, temp):
+
+    def _combine_records(self, match, partial, columns):
         """
-        combine result dataframes for batch
+        combine a matches and partials row for abritamr.txt - partials are marked with ^ and joined to matches in the same drug class
         """
-        if existing.empty:
-            existing = temp
-        else:
-            existing = pandas.concat([existing,temp])
-        
-        return existing
+        row = {'Isolate': match['Isolate']}
+        for c in columns:
+            m = match.get(c, '')
+            p = partial.get(c, '')
+            p = f"{p.strip('*')}^" if p != '' else ''
+            row[c] = ','.join([i for i in [m, p] if i != ''])
+        return row
+
+    def _wide_records(self, wide):
+        """
+        the rows of a pivoted summary as records, leaving out the drug classes not found in each isolate
+        """
+        columns = list(wide.columns)
+        for row in wide.itertuples(index = False, name = None):
+            yield {c: v for c, v in zip(columns, row) if c == 'Isolate' or isinstance(v, str)}
+
+    def stream_collate(self, prefixes, path = '', lines = None):
+        """
+        collate the batch a block of STREAM_BLOCK samples at a time with the vectorised engine, writing each block's rows to disk so that memory does not grow with the size of the batch
+        """
+        reftab = self._get_refindex()
+        prefixes = [f"{p}" for p in prefixes]
+        writers = self.summary_writers(path = path)
+        for start in range(0, len(prefixes), self.STREAM_BLOCK):
+            block = prefixes[start:start + self.STREAM_BLOCK]
+            hits = self._classify_hits(self._read_hits(block, lines = lines), reftab)
+            for writer, category in zip(writers, ["match", "partial", "other"]):
+                for rec in self._wide_records(self._pivot_hits(hits, block, category)):
+                    writer.write(rec)
+            self.logger.debug(f"Collated results for {start + len(block)} of {len(prefixes)} samples.")
+        self.logger.info(f"Collated results for {len(prefixes)} samples.")
+        self.close_writers(writers, path = path)
+        return True
 
-    def _batch_collate(self,input_file):
+    def summary_writers(self, path = ''):
+        """
+        open streaming writers for summary_matches, summary_partials and summary_virulence
+        """
+        return [SummaryWriter(f"{path}/{f}" if path != '' else f"{f}") for f in ['summary_matches.txt', 'summary_partials.txt', 'summary_virulence.txt']]
 
+    def close_writers(self, writers, path = ''):
+        """
+        finish the streamed summaries and write the combined abritamr.txt from the spooled matches and partials
+        """
+        match, partial, virulence = writers
+        for writer in writers:
+            self.logger.info(f"Saving {writer.path}")
+        if match.columns == [] and partial.columns == [] and virulence.columns == []:
+            for writer in writers:
+                writer.close()
+            return True
+        columns = match.columns + [c for c in partial.columns if c not in match.columns]
+        combd_out = f"{path}/abritamr.txt" if path != '' else f"abritamr.txt"
+        self.logger.info(f"Saving combined file : {combd_out}")
+        # pandas outer merges sort on the isolate, so the combined file is sorted too
+        combined = SummaryWriter(combd_out, sort = True)
+        for m, p in zip(match.rows(), partial.rows()):
+            combined.write(self._combine_records(m, p, columns))
+        combined.columns = columns
+        for writer in writers + [combined]:
+            writer.close()
+        return True
 
-        summary_matches = pandas.DataFrame()
-        summary_partial = pandas.DataFrame()
-        summary_virulence = pandas.DataFrame()
+    def _hit_lines(self, prefix):
+        """
+        the fields of each hit in the amrfinder.out of a sample, only the columns needed for collation
+        """
+        with open(f"{prefix}/amrfinder.out", 'r') as f:
+            header = f.readline().rstrip("\n").split("\t")
+            idx = [header.index(c) for c in self.HIT_COLS]
+            return [[fields[i] for i in idx] for fields in (line.rstrip("\n").split("\t") for line in f)]
 
-        df = pandas.read_csv(input_file, sep = '\t', header = None)
-        for row in df.iterrows():
-            prefix = f"{row[1][0]}"
-            self.logger.info(f"Collating results for {prefix}")
-            temp_match, temp_partial, temp_virulence = self.collate(prefix = prefix)
-            summary_matches = self._combine_df(existing = summary_matches, temp = temp_match)
-            summary_partial = self._combine_df(existing = summary_partial, temp = temp_partial)
-            summary_virulence = self._combine_df(existing = summary_virulence, temp = temp_virulence)
-        
+    def _read_hits(self, prefixes, chunk = 1000, lines = None):
+        """
+        read the amrfinder.out for every sample into one long table, with the position of the sample in the batch in the sample column. Only the columns needed for collation are kept and files are parsed in chunks with a single read_csv each. Samples already read (lines, from collect_job) are not read again.
+        """
+        lines = {} if lines is None else lines
+        frames = []
+        for start in range(0, len(prefixes), chunk):
+            buf = io.StringIO()
+            buf.write("\t".join(['sample'] + self.HIT_COLS) + "\n")
+            for pos, prefix in enumerate(prefixes[start:start + chunk], start = start):
+                rows = lines.get(prefix)
+                for fields in (self._hit_lines(prefix) if rows is None else rows):
+                    buf.write("\t".join([f"{pos}"] + fields) + "\n")
+            buf.seek(0)
+            tab = pandas.read_csv(buf, sep = "\t", dtype = str)
+            tab['sample'] = tab['sample'].astype(int)
+            frames.append(tab)
+        if frames == []:
+            return pandas.DataFrame(columns = ['sample'] + self.HIT_COLS)
+        return pandas.concat(frames, ignore_index = True)
+
+    def _classify_hits(self, hits, reftab):
+        """
+        assign every hit to matches, partials or other and resolve its drug class and name - the same rules as get_per_isolate, applied to the whole batch at once
+        """
+        method = hits["Method"].fillna('')
+        amr = (hits["Element type"] == "AMR") & (hits["Element subtype"] != "AMR-SUSCEPTIBLE")
+        in_match = method.isin(self.MATCH)
+        pointn = method.str.contains("POINTN", regex = False) & amr & ~in_match
+        # aac(6')-Ib-cr is always a partial - unclear
+        always_partial = (hits["Gene symbol"] == "aac(6')-Ib-cr") & method.isin(["EXACTX", "ALLELEX"])
+        hits["category"] = numpy.select(
+            [always_partial, in_match & amr, pointn, ~in_match & amr],
+            ["partial", "match", "match", "partial"],
+            default = "other"
+        )
+        hits["pointn"] = pointn & ~always_partial
+
+        # resolve each distinct hit once against the refgenes index then join back onto the batch
+        amr_hits = hits["category"] != "other"
+        keys = hits.loc[amr_hits, ["Gene symbol", "Accession of closest sequence", "Method", "pointn"]].drop_duplicates()
+        index = self._refindex(reftab)
+        resolved = [
+            index.resolve(gene_symbol = g, accession = a, method = m, pointn = p)
+            for g, a, m, p in keys.itertuples(index = False, name = None)
+        ]
+        keys["drugclass"] = [r[0] for r in resolved]
+        keys["drugname"] = [r[1] for r in resolved]
+        hits = hits.merge(keys, on = ["Gene symbol", "Accession of closest sequence", "Method", "pointn"], how = "left", sort = False)
+        other = hits["category"] == "other"
+        hits["drugclass"] = hits["drugclass"].astype(object).where(~other, hits["Element subtype"].str.capitalize())
+        hits["drugname"] = hits["drugname"].astype(object).where(~other, hits["Gene symbol"])
+        return hits
+
+    def _pivot_hits(self, hits, isolates, category):
+        """
+        pivot the hits of one category to a wide table - one row per isolate and one column per drug class, columns in the order first seen
+        """
+        hits = hits[hits["category"] == category]
+        order = list(hits.drop_duplicates(subset = "drugclass")["drugclass"])
+        names = hits[["sample", "drugclass", "drugname"]].drop_duplicates()
+        names = names.sort_values(["sample", "drugclass", "drugname"])
+        joined = {}
+        for key, name in zip(zip(names["sample"], names["drugclass"]), names["drugname"]):
+            joined.setdefault(key, []).append(name)
+        if joined != {}:
+            joined = pandas.Series({k: ",".join(v) for k, v in joined.items()})
+            wide = joined.unstack(1)
+        else:
+            wide = pandas.DataFrame()
+        wide = wide.reindex(index = range(len(isolates)), columns = order).astype(object)
+        wide.columns.name = None
+        wide.insert(0, "Isolate", list(isolates))
+        return wide
+
+    def collate_all(self, prefixes, lines = None):
+        """
+        collate a whole batch in one pass - concatenate all hits, classify them with vectorised masks and pivot to the summary layouts
+        """
+        reftab = self._get_refindex()
+        prefixes = [f"{p}" for p in prefixes]
+        hits = self._read_hits(prefixes, lines = lines)
+        self.logger.info(f"Opened amrfinder output for {len(prefixes)} samples ({hits.shape[0]} hits)")
+        hits = self._classify_hits(hits, reftab)
+        summary_matches = self._pivot_hits(hits, prefixes, "match")
+        summary_partial = self._pivot_hits(hits, prefixes, "partial")
+        summary_virulence = self._pivot_hits(hits, prefixes, "other")
         return summary_matches, summary_partial, summary_virulence
 
+    def collect_job(self, job):
+        """
+        read the hits of a sample as soon as amrfinder has finished with it - used as the on_complete callback of RunFinder so that reading the outputs overlaps with samples that are still running. Hits are kept for at most STREAM_BATCH samples, larger batches are streamed from disk.
+        """
+        if job.returncode != 0 or not pathlib.Path(f"{job.prefix}/amrfinder.out").exists():
+            return False
+        if getattr(self, 'collected', None) is None:
+            self.collected = {}
+        if len(self.collected) >= self.STREAM_BATCH:
+            return False
+        self.logger.debug(f"Reading results for {job.prefix}")
+        self.collected[f"{job.prefix}"] = self._hit_lines(job.prefix)
+        return True
+
+    def _batch_path(self):
+        """
+        where batch summaries are saved - the shard directory when running a shard
+        """
+        return getattr(self, 'outdir', '')
+
+    def _failed(self):
+        """
+        the samples listed in the failures report of this batch, if there is one
+        """
+        path = pathlib.Path(self._batch_path()) / self.FAILURES
+        if not path.exists():
+            return set()
+        with open(path, 'r') as f:
+            return {row['Isolate'] for row in csv.DictReader(f, delimiter = '\t')}
+
     def run(self):
 
 
@@ -305,29 +494,35 @@ class Collate:
             self.logger.critical(f"The refgenes DB ({self.REFGENES}) seems to be missing.")
             raise SystemExit
 
+        collected = getattr(self, 'collected', None)
         if self.run_type != 'batch':
             self.logger.info(f"This is a single sample run.")
-            summary_drugs, summary_partial, virulence = self.collate(prefix = self.prefix)
+            summary_drugs, summary_partial, virulence = self.collate_all(prefixes = [self.prefix], lines = collected)
         else:
             self.logger.info(f"You are running abritamr in batch mode. Your collated results will be saved.")
-            summary_drugs, summary_partial, virulence = self._batch_collate(input_file = self.input)
+            prefixes = pandas.read_csv(self.input, sep = '\t', header = None, dtype = str, keep_default_na = False)[0]
+            failed = self._failed()
+            if failed:
+                self.logger.warning(f"{len(failed)} samples failed in amrfinder and will not be collated, see {pathlib.Path(self._batch_path()) / self.FAILURES}.")
+                prefixes = prefixes[~prefixes.astype(str).isin(failed)].reset_index(drop = True)
+            if collected:
+                self.logger.info(f"{len(collected)} of {len(prefixes)} samples were read while amrfinder was running.")
+            if len(prefixes) > self.STREAM_BATCH:
+                self.logger.info(f"This is a large batch, rows will be streamed to disk as they are collated.")
+                return self.stream_collate(prefixes = prefixes, path = self._batch_path(), lines = collected)
+            summary_drugs, summary_partial, virulence = self.collate_all(prefixes = prefixes, lines = collected)
+        self.summaries = (summary_drugs, summary_partial, virulence)
         self.logger.info(f"Saving files now.")
-        self.save_files(path='' if self.run_type == 'batch' else f"{self.prefix}", match = summary_drugs,partial=summary_partial, virulence = virulence)
+        self.save_files(path=self._batch_path() if self.run_type == 'batch' else f"{self.prefix}", match = summary_drugs,partial=summary_partial, virulence = virulence)
         
 class MduCollate(Collate):
-    
+
+    GENERAL_COLS = ['Item code','Resistance genes (alleles) detected','Resistance genes (alleles) det (non-rpt)','Species_obs', 'Species_exp', 'db_version']
+    RULES = GeneralRules()
+    MDUID = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,2})?')
+
     def __init__(self, args):
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.sop = args.sop
         self.sop_name = args.sop_name
         self.mduqc = args.qc
@@ -335,6 +530,7 @@ class MduCollate(Collate):
         self.partials = args.partials
         self.match = args.matches
         self.runid = args.runid
+        self.format = args.format
         self.NONE_CODES = {
             "Salmonella":"CPase_ESBL_AmpC_16S_NEG",
             "Shigella":"CPase_ESBL_AmpC_16S_NEG",
@@ -357,6 +553,41 @@ class MduCollate(Collate):
         
         return pandas.concat([tab,pos])
 
+    def _mdu_key(self, isolate):
+        """
+        the name an isolate is looked up by in the QC - without any path, surrounding space or case
+        """
+        return f"{isolate}".strip().split('/')[-1].upper()
+
+    def qc_index(self):
+        """
+        the QC table with the normalised name and MDU ID of each isolate, read once for the run
+        """
+        if getattr(self, 'qc', None) is None:
+            qc = self.mdu_qc_tab().reset_index(drop = True)
+            qc['KEY'] = qc['ISOLATE'].map(self._mdu_key)
+            qc['MDU_ID'] = qc['KEY'].str.extract(f"^{self.MDUID.pattern}")['id']
+            self.qc = qc
+        return self.qc
+
+    def qc_join(self, isolates):
+        """
+        the QC row for each isolate, in the order given. Isolates are matched on their whole name and then on their MDU ID, so an ID that is the start of another can not pick up the wrong QC.
+        """
+        qc = self.qc_index()
+        cols = ['ISOLATE', 'SPECIES_EXP', 'SPECIES_OBS', 'TEST_QC']
+        # whole names are looked up before MDU IDs, and the first QC row is used for either
+        lookup = pandas.concat([qc.set_index('KEY')[cols], qc.dropna(subset = ['MDU_ID']).set_index('MDU_ID')[cols]])
+        lookup = lookup[~lookup.index.duplicated()]
+        key = pandas.Series(isolates).map(self._mdu_key)
+        key = key.where(key.isin(lookup.index), key.str.extract(f"^{self.MDUID.pattern}")['id'])
+        joined = pandas.DataFrame({'Isolate': list(isolates), 'KEY': key}).merge(lookup, left_on = 'KEY', right_index = True, how = 'left')
+        missing = joined[joined['SPECIES_EXP'].isna()]['Isolate']
+        if not missing.empty:
+            self.logger.critical(f"{', '.join(f'{m}' for m in missing)} could not be found in the QC file {self.mduqc}. Please check your inputs and try again.")
+            raise SystemExit
+        return joined.reset_index(drop = True)
+
     def strip_bla(self, gene):
         '''
         strip bla from front of genes except
@@ -379,17 +610,6 @@ class MduCollate(Collate):
     # report vanA*, B*, C*, vanD*, vanE*, vanG*, vanL*, vanM*, vanN* 
     # Methicillin ALL
 
-    def get_all_genes(self, row):
-        all_genes = []
-        for r in row[1]:
-            if isinstance(r, str):
-                if len(r.split(",")) > 1:
-                    for a in r.split(","):
-                        all_genes.append(a)
-                else:
-                    all_genes.append(r)
-        return all_genes
-
     def none_replacement_code(self, genus):
 
         if genus in self.NONE_CODES:
@@ -398,7 +618,7 @@ class MduCollate(Collate):
             return "CPase_16S_mcr_NEG"
 
     def assign_itemcode(self,mduid, reg):
-        self.logger.info(f"Checking for item code")
+        self.logger.debug(f"Checking for item code in {mduid}")
         m = reg.match(mduid)
         try:
             itemcode = m.group('itemcode') if m.group('itemcode') else ''
@@ -407,7 +627,7 @@ class MduCollate(Collate):
         return itemcode
 
     def assign_mduid(self, mduid, reg):
-        self.logger.info(f"Extracting MDU sample ID")
+        self.logger.debug(f"Extracting MDU sample ID from {mduid}")
         m = reg.match(mduid)
         try:
             mduid = m.group('id')
@@ -415,6 +635,16 @@ class MduCollate(Collate):
             mduid = mduid.split('/')[-1]
         return mduid
 
+    def mdu_ids(self, isolates, reg):
+        """
+        the MDU sample ID and item code of each isolate, with a single summary in the log
+        """
+        ids = [self.assign_mduid(i, reg) for i in isolates]
+        itemcodes = [self.assign_itemcode(i, reg) for i in isolates]
+        unmatched = sum(reg.match(i) is None for i in isolates)
+        self.logger.info(f"Extracted MDU sample IDs and item codes for {len(isolates)} isolates{f', {unmatched} did not match the MDU ID pattern and are reported by name' if unmatched else ''}.")
+        return ids, itemcodes
+
     def _ampicillin_res_sal(self, col, gene):
         
         if col in [ 'Beta-lactamase (not ESBL or carbapenemase)','ESBL','ESBL (AmpC type)', 'Beta-lactamase (narrow-spectrum)','Beta-lactamase (unknown spectrum)'] or 'Ampicillin' in col:
@@ -511,28 +741,11 @@ class MduCollate(Collate):
             return gene
         return ''
     
-    def reporting_logic_salmonella(self, row):
-
-        # Ampicillin - ResMech	Ampicillin - Interpretation	
-        # Cefotaxime (ESBL) - ResMech	Cefotaxime (ESBL) - Interpretation	
-        # Cefotaxime (AmpC) - ResMech	Cefotaxime (AmpC) - Interpretation	
-        # Tetracycline - ResMech	Tetracycline - Interpretation	
-        # Gentamycin - ResMech	Gentamycin - Interpretation	
-        # Sulfathiazole - ResMech	Sulfathiazole - Interpretation	
-        # Trimethoprim - ResMech	Trimethoprim - Interpretation	
-        # Ciprofloxacin - ResMech	Ciprofloxacin - Interpretation	
-        # Azithromycin - ResMech	Azithromycin - Interpretation
-
-        mduidreg = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,2})?')
-        
-        all_genes = self.get_all_genes(row)
-        all_genes = [a for a in all_genes if a != row[1]['Isolate'] and a != '']
-                
-        isodict = row[1].to_dict()
-        item_code = self.assign_itemcode(row[1]['Isolate'], mduidreg)
-        md = self.assign_mduid(row[1]['Isolate'], mduidreg)
-
-        abx = {
+    def _salmonella_abx(self):
+        """
+        the rule deciding which drug class columns count towards each antibiotic - Trim-Sulpha is made from Trimethoprim and Sulfathiazole
+        """
+        return {
             "Ampicillin" : self._ampicillin_res_sal,
             "Cefotaxime (ESBL)":self._cefo_esbl_res_sal,
             "Cefotaxime (AmpC)":self._cefo_ampc_res_sal,
@@ -546,165 +759,49 @@ class MduCollate(Collate):
             "Ciprofloxacin":self._cipro_res_salmo,
             "Sulfathiazole":self._sulf_res_salmo,
             "Trimethoprim":self._trimet_res_salmo,
-            "Trim-Sulpha":self._trim_sulpha_salmo,
             "Chloramphenicol":self._chloramphenicol_res_sal,
             "Aminoglycosides (RMT)": self._rmt_res_salmo,
             "Colistin":self._colistin_res_salmo
         }
 
-        
-        tmp_results = {
-            "Ampicillin":[],	
-            "Cefotaxime (ESBL)":[],
-            "Cefotaxime (AmpC)":[],
-            "Tetracycline":[],
-            "Gentamicin":[],
-            "Sulfathiazole":[],
-            "Trimethoprim":[],
-            "Trim-Sulpha":[],
-            "Kanamycin":[],
-            "Streptomycin":[],
-            "Spectinomycin":[],
-            "Ciprofloxacin":[],
-            "Azithromycin":[],
-            "Meropenem":[],
-            "Chloramphenicol":[],
-            "Aminoglycosides (RMT)":[],"Colistin":[], "Other":[]
-        }
+    def salmonella_columns(self, columns):
+        """
+        the (column, antibiotic) pairs of a summary - which antibiotics the genes of each drug class column count towards, worked out once for the file
+        """
+        abx = self._salmonella_abx()
+        pairs = [(col, ab) for col in columns if col != 'Isolate' for ab, rule in abx.items() if rule(col = col, gene = 'gene') != '']
+        return pandas.DataFrame(pairs, columns = ['col', 'ab'])
 
-        
-        for ab in abx:
-            if ab != 'Trim-Sulpha':
-                for i in isodict:
-                    if i != "Isolate":
-                        
-                        g = abx[ab](col = i, gene = isodict[i])
-                        
-                        if g != '':
-                            gene_list = g.split(',')
-                            for gene in gene_list:
-                                tmp_results[ab].append(gene)
-                                if gene in all_genes:
-                                    all_genes.remove(gene)
-            
-        # interprete results
-        tmp_results['Other'] = all_genes
-        results = {'Isolate': row[1]['Isolate'], 'MDU Sample ID':md, 'Item code': item_code}
-        # for Trim-Sulpha
-        
-        if tmp_results['Trimethoprim'] != [] and tmp_results['Sulfathiazole'] != []:
-            tmp_results['Trim-Sulpha'] = list(set(tmp_results['Trimethoprim']).union(tmp_results['Sulfathiazole']))
-        
-        for res in tmp_results:
-            results[f"{res} - ResMech"] = ';'.join(tmp_results[res]) if tmp_results[res] != [] else "None detected"              
-            if res in ["Aminoglycosides (RMT)","Colistin", "Other"]:
-                results[f"{res} - Interpretation"] = ''
-            elif res == 'Ciprofloxacin':
-                if tmp_results[res] == []:
-                    results[f"{res} - Interpretation"] = 'Susceptible'
-                elif len(tmp_results[res]) == 1:
-                    results[f"{res} - Interpretation"] = 'Intermediate'
-                else:
-                    results[f"{res} - Interpretation"] = 'Resistant'
-            elif res not in ["Aminoglycosides (RMT)","Colistin", "Other"]:
-                if tmp_results[res] == []:
-                    results[f"{res} - Interpretation"] = 'Susceptible'
-                else:
-                    results[f"{res} - Interpretation"] = 'Resistant'
-        
-        return results
+    def summary_genes(self, df):
+        """
+        explode a summary into a table with a row per gene - the position of the isolate, the column and the gene, in the order of the summary
+        """
+        values = df.reset_index(drop = True).stack()
+        values = values[values.map(lambda v: isinstance(v, str) and v != '')].astype(str)
+        genes = values.str.split(',').explode()
+        return pandas.DataFrame({
+            'row': genes.index.get_level_values(0).to_numpy(),
+            'col': genes.index.get_level_values(1),
+            'gene': genes.to_numpy()
+        })
 
-            
-    def reporting_logic_general(self, row, species, neg_code = True):
-        # get all genes found
-        all_genes = self.get_all_genes(row)
-        isodict = row[1].to_dict()
-        # determine the genus EXPECTED
-        genus = species.split()[0]
-        reportable = [
-            "Carbapenemase",
-            "Carbapenemase (MBL)",
-            "Carbapenemase (KPC variant)"
-            "Carbapenemase (OXA-51 family)",
-            "ESBL",
-            "ESBL (AmpC type)",
-            "Aminoglycosides (Ribosomal methyltransferase)",
-            "Colistin",
-            "Oxazolidinone & phenicol resistance", # Oxazolidinone or linezolid = reportable
-            "Vancomycin",
-            "Methicillin"
-        ]
-        non_caveat_reportable = [
-            "Carbapenemase",
-            "Carbapenemase (KPC variant)",
-            "Aminoglycosides (Ribosomal methyltransferase)",
-            "Colistin"
-        ]
-        # Carbapenemase (KPC variant)
-# Carbapenemase (MBL)
-# Carbapenemase (OXA-51 family)
-
-        abacter_excluded = [
-            "Acinetobacter baumannii",
-            "Acinetobacter calcoaceticus",
-            "Acinetobacter nosocomialis",
-            "Acinetobacter pittii",
-            "Acinetobacter baumannii complex"
-        ]
 
-        
-        van_match = re.compile(r"van[A,B,C,D,E,G,L,M,N][\S]*")
-        mec_match = re.compile(r"mec[^IR]")
-        
-        genes_reported = []  # genes for reporting
-        genes_not_reported = []  # genes found but not reportable
-        for i in isodict:
-            genes = []
-            if i != 'Isolate':
-                if isinstance(isodict[i], str):
-                    genes = isodict[i].split(',')
-                    genes = [gene for gene in genes if '_' not in gene]
-                if genes != []: # for each bin we do things to genes
-                    if i in reportable: #don't report point mutations
-                        if i in non_caveat_reportable:
-                            genes_reported.extend(genes)
-                        elif i == "Carbapenemase (MBL)" and species != "Stenotrophomonas maltophilia":
-                            genes_reported.extend(genes)
-                        elif i == "Carbapenemase (MBL)" and species == "Stenotrophomonas maltophilia":
-                            # if species is "Stenotrophomonas maltophilia" don't report blaL1
-                            genes_reported.extend([g for g in genes if not g.startswith("blaL1")])
-                            genes_not_reported.extend([g for g in genes if g.startswith("blaL1")])
-                        elif i == "Carbapenemase (OXA-51 family)" and species not in abacter_excluded:
-                            genes_reported.extend(genes)
-                        elif i in ["ESBL","ESBL (AmpC type)"] and genus in ["Salmonella"]: 
-                            genes_reported.extend(genes)
-                        elif i in ["ESBL","ESBL (AmpC type)"] and genus in ["Shigella"]: 
-                            genes_reported.extend([g for g in genes if "blaEC" not in g])
-                            genes_not_reported.extend([g for g in genes if "blaEC" in g]) # don't report blaEC for shigella
-                        elif i == "Vancomycin":
-                            genes_reported.extend([g for g in genes if van_match.match(g)])
-                            genes_not_reported.extend([g for g in genes if not van_match.match(g)])
-                        elif i == "Methicillin":
-                            genes_reported.extend([g for g in genes if mec_match.match(g)])
-                            genes_not_reported.extend([g for g in genes if not mec_match.match(g)])
-                        else:
-                            genes_not_reported.extend(genes)
-                    elif "Oxazolidinone" in i or "Linezolid" in i:
-                        if species in ["Staphylococcus aureus","Staphylococcus argenteus"] or genus == "Enterococcus":
-                            genes_reported.extend(genes)
-                        else:
-                            genes_not_reported.extend(genes)
-
-                    else:
-                        genes_not_reported.extend(genes)
-        if genes_reported == []:
-            genes_reported = [self.none_replacement_code(genus= genus)] if neg_code else ''
-        if genes_not_reported == []:
-            genes_not_reported = ["No non-reportable genes found."] if neg_code else ''
-            # break
-        
-        self.logger.info(f"{row[1]['Isolate']} has {len(genes_reported)} reportable genes.")
-        return genes_reported, genes_not_reported
+    def general_genes(self, match_df, species):
+        """
+        explode a summary into a table with a row per gene found - the position of the isolate, the drug class, the species and the gene. Genes keep the order of the summary and point mutations (with _ in their name) are left out.
+        """
+        classes = [c for c in match_df.columns if c != 'Isolate']
+        values = match_df[classes].reset_index(drop = True).stack().dropna()
+        values = values[values.map(lambda v: isinstance(v, str))].astype(str)
+        genes = values.str.split(',').explode()
+        genes = genes[~genes.str.contains('_', regex = False)]
+        rows = genes.index.get_level_values(0).to_numpy()
+        return pandas.DataFrame({
+            'row': rows,
+            'class': genes.index.get_level_values(1),
+            'species': numpy.asarray(species, dtype = object)[rows],
+            'gene': genes.to_numpy()
+        })
 
     def mdu_reporting_salmonella(self, match, isolates):
 
@@ -731,72 +828,97 @@ class MduCollate(Collate):
         "Other - ResMech",
         "Other - Interpretation"]
         # select passed Salmonella
-        
         df = pandas.read_csv(match, sep = '\t')
-        df = df[df['Isolate'].isin(isolates)]
-        result_df = pandas.DataFrame()
-        df = df.fillna('')
-        for row in df.iterrows():
-            isolate_results = self.reporting_logic_salmonella(row = row)
-            tmpdf = pandas.DataFrame(isolate_results, index = [0])
-            if result_df.empty:
-                result_df = tmpdf
+        df = df[df['Isolate'].isin(isolates)].fillna('').reset_index(drop = True)
+        names = df['Isolate'].tolist()
+        n = len(names)
+        genes = self.summary_genes(df)
+        # each gene counts towards every antibiotic its column is mapped to
+        hits = genes[genes['col'] != 'Isolate'].reset_index().merge(self.salmonella_columns(df.columns), on = 'col').sort_values(['row', 'index'], kind = 'stable')
+        found = {ab: self._gene_lists(hits[hits['ab'] == ab], n) for ab in self._salmonella_abx()}
+        self.logger.info(f"Applying the Salmonella rules to {n} isolates.")
+        trim_sulpha = [list(set(t).union(s)) if t != [] and s != [] else [] for t, s in zip(found['Trimethoprim'], found['Sulfathiazole'])]
+        found['Trim-Sulpha'] = trim_sulpha
+        # Other - the genes left once one of each has been taken for every antibiotic it counts towards
+        others = genes[(genes['gene'] != '') & (genes['gene'].to_numpy() != numpy.asarray(names, dtype = object)[genes['row'].to_numpy()])]
+        taken = hits.groupby(['row', 'gene']).size()
+        seen = others.groupby(['row', 'gene']).cumcount()
+        taken = taken.reindex(pandas.MultiIndex.from_arrays([others['row'], others['gene']]), fill_value = 0).to_numpy()
+        found['Other'] = self._gene_lists(others[seen.to_numpy() >= taken], n)
+        mduids, itemcodes = self.mdu_ids(names, self.MDUID)
+        results = {'Isolate': names, 'MDU Sample ID': mduids, 'Item code': itemcodes}
+        for res, genes_found in found.items():
+            results[f"{res} - ResMech"] = [';'.join(g) if g != [] else "None detected" for g in genes_found]
+            counts = numpy.array([len(g) for g in genes_found], dtype = int)
+            if res in ["Aminoglycosides (RMT)","Colistin", "Other"]:
+                results[f"{res} - Interpretation"] = [''] * n
+            elif res == 'Ciprofloxacin':
+                results[f"{res} - Interpretation"] = numpy.select([counts == 0, counts == 1], ['Susceptible', 'Intermediate'], 'Resistant').tolist()
             else:
-                result_df = result_df.append(tmpdf)
-        return result_df[cols]
+                results[f"{res} - Interpretation"] = numpy.where(counts == 0, 'Susceptible', 'Resistant').tolist()
+        return pandas.DataFrame(results, columns = cols)
 
     def _extract_plus_isolates(self,species):
 
-        qc = self.mdu_qc_tab()
+        qc = self.qc_index()
         qc = qc[(qc['SPECIES_OBS'] == species) & (qc['TEST_QC'] == 'PASS')]
 
         return list(qc["ISOLATE"])
 
 
+    def _gene_lists(self, genes, n):
+        """
+        the genes of each of n isolates, in the order found
+        """
+        found = [[] for _ in range(n)]
+        for row, gene in zip(genes['row'].tolist(), genes['gene'].tolist()):
+            found[row].append(gene)
+        return found
+
+    def _join_genes(self, genes, n):
+        """
+        the genes of each of n isolates as a comma separated string, in the order found
+        """
+        return [','.join(g) for g in self._gene_lists(genes, n)]
+
     def mdu_reporting_general(self, match, neg_code = True):
 
         self.logger.info(f"Applying MDU business logic {'matches' if neg_code else 'partials'}.")
-        mduidreg = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,2})?')
-        reporting_df = pandas.DataFrame()
-        qc = self.mdu_qc_tab()
+        mduidreg = self.MDUID
         match_df = pandas.read_csv(match, sep = '\t')
-        for row in match_df.iterrows():
-            isolate = row[1]['Isolate']
-            item_code = self.assign_itemcode(isolate, mduidreg)
-            md = self.assign_mduid(isolate, mduidreg)
-            d = {"MDU sample ID": md, "Item code" : item_code}
-            qcdf = qc[qc['ISOLATE'].str.contains(isolate)]
-            exp_species = qcdf["SPECIES_EXP"].values[0]
-            obs_species = qcdf["SPECIES_OBS"].values[0]
-           
-            species = obs_species if obs_species == exp_species else exp_species
-            genes_reported, genes_not_reported = self.reporting_logic_general(
-                row=row, species=species, neg_code=neg_code
-            )
-            
-            # strip bla
-            genes_not_reported = [self.strip_bla(g) for g in genes_not_reported]
-            genes_not_reported = [g for g in genes_not_reported if g != isolate]
-            genes_reported = [self.strip_bla(g) for g in genes_reported]
-            genes_reported = [g for g in genes_reported if g != isolate]
-            d["Resistance genes (alleles) detected"] = ",".join(genes_reported)
-            d["Resistance genes (alleles) det (non-rpt)"] = ",".join(genes_not_reported)
-            if qcdf["TEST_QC"].values[0] == 'FAIL': # species not needed for MDU LIMS upload
-                d["Species_exp"] = exp_species
-            d["Species_obs"] = obs_species
-            d["Species_exp"] = exp_species
-            d['db_version'] = self.db
-            tempdf = pandas.DataFrame(d, index=[0])
-            tempdf = tempdf.set_index("MDU sample ID")
-            
-            if reporting_df.empty:
-                reporting_df = tempdf
-            else:
-                reporting_df = pandas.concat([reporting_df,tempdf])
-        
-        return reporting_df.reindex(labels = ['Item code','Resistance genes (alleles) detected','Resistance genes (alleles) det (non-rpt)','Species_obs', 'Species_exp', 'db_version'], axis = 'columns')
+        isolates = match_df['Isolate'].tolist()
+        qc = self.qc_join(isolates)
+        # the expected species is used for reporting
+        species = qc['SPECIES_EXP'].tolist()
+        genes = self.general_genes(match_df, species)
+        genes['reported'] = self.RULES.reported(genes)
+        # whether each isolate has reportable and non-reportable genes, before names are tidied
+        found = genes.groupby('row')['reported'].agg(['sum', 'count']).reindex(range(len(isolates)), fill_value = 0)
+        reportable = (found['sum'] > 0).to_numpy()
+        non_reportable = (found['count'] > found['sum']).to_numpy()
+        # bla is stripped from the names and anything named after the isolate dropped
+        strip = {g: self.strip_bla(g) for g in genes['gene'].unique()}
+        genes['gene'] = genes['gene'].map(strip)
+        genes = genes[genes['gene'].to_numpy() != numpy.asarray(isolates, dtype = object)[genes['row'].to_numpy()]]
+        detected = pandas.Series(self._join_genes(genes[genes['reported']], len(isolates)))
+        not_detected = pandas.Series(self._join_genes(genes[~genes['reported']], len(isolates)))
+        if neg_code:
+            detected = detected.where(reportable, [self.none_replacement_code(genus = f"{s}".split()[0]) for s in species])
+            not_detected = not_detected.where(non_reportable, "No non-reportable genes found.")
+        mduids, itemcodes = self.mdu_ids(isolates, mduidreg)
+        reporting_df = pandas.DataFrame({
+            "MDU sample ID": mduids,
+            "Item code": itemcodes,
+            "Resistance genes (alleles) detected": detected.tolist(),
+            "Resistance genes (alleles) det (non-rpt)": not_detected.tolist(),
+            "Species_obs": qc['SPECIES_OBS'].tolist(),
+            "Species_exp": qc['SPECIES_EXP'].tolist(),
+            "db_version": self.db
+        }, columns = ["MDU sample ID"] + self.GENERAL_COLS).set_index("MDU sample ID")
+        self.logger.info(f"{int(reportable.sum())} of {len(isolates)} isolates have reportable genes.")
+        return reporting_df.reindex(labels = self.GENERAL_COLS, axis = 'columns')
+
 
-    
     def save_spreadsheet_general(
         self,
         passed_match,
@@ -804,18 +926,16 @@ class MduCollate(Collate):
         
     ):
         self.logger.info(f"Saving {self.sop_name}.")
-        writer = pandas.ExcelWriter(f"{self.runid}_{self.sop_name}.xlsx", engine="xlsxwriter")
-        passed_match.to_excel(writer, sheet_name=f"{self.sop_name}")
-        passed_partials.to_excel(writer, sheet_name="Passed QC partial")
-        writer.close()
+        with ReportWriter(f"{self.runid}_{self.sop_name}", self.format) as writer:
+            writer.write_frame(f"{self.sop_name}", passed_match)
+            writer.write_frame("Passed QC partial", passed_partials)
 
     def save_spreadsheet_interpreted(self, results):
         sheets = {"Salmonella enterica":f"{self.sop_name}-01"}
         self.logger.info(f"Saving MMS184")
-        writer = pandas.ExcelWriter(f"{self.runid}_{self.sop_name}.xlsx", engine = "xlsxwriter")
-        for result in results:
-            result[1].to_excel(writer, sheet_name = sheets[result[0]], index = False)
-        writer.close()
+        with ReportWriter(f"{self.runid}_{self.sop_name}", self.format) as writer:
+            for result in results:
+                writer.write_frame(sheets[result[0]], result[1], index = False)
 
     def run(self):
         if self.sop == 'general' and pathlib.Path(self.partials).exists():
@@ -837,3 +957,92 @@ class MduCollate(Collate):
                 else:
                     self.logger.info(f"There are no {r} in this run. Collation will be skipped.")
             self.save_spreadsheet_interpreted(results = dfs)
+
+
+class MergeShards(object):
+    """
+    merge the summaries of a batch that was run as shards (abritamr run --shard i/N). Tables are merged a row at a time - the columns are the union of the shard columns, in the order first seen.
+    """
+    SUMMARIES = ['summary_matches.txt', 'summary_partials.txt', 'summary_virulence.txt']
+    COMBINED = 'abritamr.txt'
+    FAILURES = 'abritamr_failures.tsv'
+
+    def __init__(self, args):
+        self.logger = get_logger(__name__)
+        self.shards = args.shards
+        self.outdir = args.outdir
+
+    def _shard_dirs(self):
+        """
+        the shard directories to merge - those given or all shard_i_of_N directories in the current directory
+        """
+        shards = self.shards
+        if not shards:
+            found = [(re.fullmatch(r'shard_(\d+)_of_(\d+)', p.name), p) for p in pathlib.Path('.').iterdir() if p.is_dir()]
+            found = [(int(m.group(2)), int(m.group(1)), f"{p}") for m, p in found if m is not None]
+            shards = [p for n, i, p in sorted(found)]
+        if shards == []:
+            self.logger.critical(f"No shards were found to merge. Please provide the shard output directories.")
+            raise SystemExit
+        for shard in shards:
+            if not pathlib.Path(shard).is_dir():
+                self.logger.critical(f"The shard {shard} is not a directory. Please check your inputs and try again.")
+                raise SystemExit
+        return shards
+
+    def _rows(self, f):
+        """
+        yield the rows of an open summary as dictionaries
+        """
+        reader = csv.reader(f, delimiter = '\t')
+        header = next(reader, [])
+        for row in reader:
+            yield dict(zip(header, row))
+
+    def merge_table(self, paths, out, sort = False):
+        """
+        merge summary tables into out. The headers are read first for the union of columns, then the rows are streamed - merged on the isolate if the tables are sorted, otherwise one table after the other.
+        """
+        columns = []
+        for path in paths:
+            with open(path, 'r') as f:
+                header = next(csv.reader(f, delimiter = '\t'), [])
+            columns.extend([c for c in header[1:] if c not in columns])
+        files = [open(path, 'r') for path in paths]
+        try:
+            streams = [self._rows(f) for f in files]
+            rows = heapq.merge(*streams, key = lambda row: row['Isolate']) if sort else itertools.chain(*streams)
+            with open(out, 'w', newline = '') as o:
+                writer = csv.writer(o, delimiter = '\t', lineterminator = '\n')
+                writer.writerow(['Isolate'] + columns)
+                n = 0
+                for row in rows:
+                    writer.writerow([row['Isolate']] + [row.get(c, '') for c in columns])
+                    n += 1
+        finally:
+            for f in files:
+                f.close()
+        self.logger.info(f"Saved {out} with {n} rows from {len(paths)} shards.")
+        return True
+
+    def run(self):
+        shards = self._shard_dirs()
+        self.logger.info(f"Merging {len(shards)} shards : {', '.join(shards)}")
+        if self.outdir != '':
+            pathlib.Path(self.outdir).mkdir(parents = True, exist_ok = True)
+        for name in self.SUMMARIES:
+            paths = [f"{shard}/{name}" for shard in shards]
+            for path in paths:
+                if not pathlib.Path(path).exists():
+                    self.logger.critical(f"{path} is missing, please check that the shard has finished.")
+                    raise SystemExit
+            self.merge_table(paths, f"{self.outdir}/{name}" if self.outdir != '' else name)
+        # the combined file is not written for a shard without any results
+        paths = [f"{shard}/{self.COMBINED}" for shard in shards if pathlib.Path(f"{shard}/{self.COMBINED}").exists()]
+        if paths != []:
+            self.merge_table(paths, f"{self.outdir}/{self.COMBINED}" if self.outdir != '' else self.COMBINED, sort = True)
+        # as are the failures reports, which are only written for shards where a sample failed
+        paths = [f"{shard}/{self.FAILURES}" for shard in shards if pathlib.Path(f"{shard}/{self.FAILURES}").exists()]
+        if paths != []:
+            self.merge_table(paths, f"{self.outdir}/{self.FAILURES}" if self.outdir != '' else self.FAILURES)
+        return True
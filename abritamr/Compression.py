@@ -0,0 +1,114 @@
+import pathlib, gzip, bz2, lzma, zlib, shutil, subprocess, tempfile, os, contextlib
+
+try:
+    import zstandard
+except ImportError: # zstd input will be read with the zstd command line tool instead
+    zstandard = None
+
+
+# what a truncated or corrupt compressed file raises while it is read
+READ_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+MAGIC = {
+    b'\x1f\x8b': 'gz',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'\x28\xb5\x2f\xfd': 'zst',
+}
+
+
+def compression(path):
+    """
+    the compression of a file from its magic bytes - gz, bz2, xz, zst or '' if it is not compressed
+    """
+    with open(path, 'rb') as f:
+        head = f.read(max(len(m) for m in MAGIC))
+    for magic, kind in MAGIC.items():
+        if head.startswith(magic):
+            return kind
+    return ''
+
+
+class CompressionError(OSError):
+    """
+    a compressed assembly could not be read to the end
+    """
+
+
+class _ZstdCli(object):
+    """
+    a readable binary stream from zstd -dc, used when the zstandard package is not installed
+    """
+    def __init__(self, path):
+        self.path = path
+        # stderr goes to a file so that a chatty zstd can never block on a full pipe
+        self.err = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(["zstd", "-dcq", f"{path}"], stdout = subprocess.PIPE, stderr = self.err)
+        except FileNotFoundError:
+            self.err.close()
+            raise CompressionError(f"zstd is needed to read .zst assemblies ({path}), please install zstd or the zstandard package (pip install zstandard).")
+
+    def read(self, size = -1):
+        return self.proc.stdout.read(size)
+
+    def __iter__(self):
+        return iter(self.proc.stdout)
+
+    def close(self, check = True):
+        """
+        wait for zstd and raise if it failed - a stream closed before the end is not checked
+        """
+        finished = self.proc.stdout.read(1) == b''
+        self.proc.stdout.close()
+        if not finished:
+            self.proc.terminate()
+        self.proc.wait()
+        self.err.seek(0)
+        stderr = self.err.read().decode(errors = 'replace').strip()
+        self.err.close()
+        if check and finished and self.proc.returncode != 0:
+            raise CompressionError(f"zstd could not decompress {self.path} (exit code {self.proc.returncode}) : {stderr}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # an error while reading is reported rather than the state of zstd
+        self.close(check = exc[0] is None)
+
+
+def open_contigs(path):
+    """
+    open a possibly compressed file for reading as bytes
+    """
+    kind = compression(path)
+    if kind == 'gz':
+        return gzip.open(path, 'rb')
+    if kind == 'bz2':
+        return bz2.open(path, 'rb')
+    if kind == 'xz':
+        return lzma.open(path, 'rb')
+    if kind == 'zst':
+        if zstandard is not None:
+            return zstandard.open(path, 'rb')
+        return _ZstdCli(path)
+    return open(path, 'rb')
+
+
+@contextlib.contextmanager
+def decompressed(path, tmpdir = None):
+    """
+    yield a path to an uncompressed copy of path for the duration of a job. Uncompressed files are used in place, compressed files are streamed to a temporary file that is removed afterwards - amrfinder reads its input more than once so a pipe can not be used.
+    """
+    if not pathlib.Path(path).is_file() or compression(path) == '':
+        # anything that is not a readable compressed file is left for amrfinder to report on
+        yield f"{path}"
+        return
+    fd, tmp = tempfile.mkstemp(dir = tmpdir, prefix = f"{pathlib.Path(path).name}.", suffix = ".fa")
+    try:
+        with os.fdopen(fd, 'wb') as out, open_contigs(path) as f:
+            shutil.copyfileobj(f, out, 1 << 20)
+        yield tmp
+    finally:
+        pathlib.Path(tmp).unlink(missing_ok = True)
@@ -1,4 +1,4 @@
-import logging
+import logging, logging.handlers, queue, threading, atexit, os
 
 class CustomFormatter(logging.Formatter):
     """Logging Formatter to add colors and count warning / errors"""
@@ -21,4 +21,50 @@ class CustomFormatter(logging.Formatter):
     def format(self, record):
         log_fmt = self.FORMATS.get(record.levelno)
         formatter = logging.Formatter(log_fmt,datefmt='%m/%d/%Y %I:%M:%S %p')
-        return formatter.format(record)
\ No newline at end of file
+        return formatter.format(record)
+
+
+LOGFILE = 'abritamr.log'
+FILE_FORMAT = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+_lock = threading.Lock()
+_listener = None
+
+
+def setup_logging(logfile = LOGFILE, debug = None):
+    """
+    configure the abritamr logger once per process - records are put on a queue and written to the console and the log file by a listener thread, so that logging is off the hot path. Both log at INFO unless debug is set (or ABRITAMR_DEBUG is in the environment), in which case the log file also gets DEBUG records. Later calls only turn debug on.
+    """
+    global _listener
+    if debug is None:
+        debug = os.environ.get('ABRITAMR_DEBUG', '') not in ('', '0')
+    level = logging.DEBUG if debug else logging.INFO
+    with _lock:
+        logger = logging.getLogger('abritamr')
+        if _listener is not None:
+            if debug:
+                logger.setLevel(logging.DEBUG)
+                _listener.handlers[1].setLevel(logging.DEBUG)
+            return _listener
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(CustomFormatter())
+        fh = logging.FileHandler(logfile)
+        fh.setLevel(level)
+        fh.setFormatter(FILE_FORMAT)
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, ch, fh, respect_handler_level = True)
+        logger.setLevel(level)
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        _listener.start()
+        # flush anything still on the queue when the process exits
+        atexit.register(_listener.stop)
+        return _listener
+
+
+def get_logger(name):
+    """
+    the logger for an abritamr module - its records go to the handlers set up by setup_logging
+    """
+    setup_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,132 @@
+import pathlib, re
+from abritamr.Compression import open_contigs
+
+
+def _records(path):
+    """
+    yield (header, sequence lines) for each record of a fasta file, as bytes
+    """
+    header, lines = None, []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield header, lines
+                header, lines = line, []
+            elif header is not None:
+                lines.append(line)
+    if header is not None:
+        yield header, lines
+
+
+def contig_lengths(path):
+    """
+    the length of each contig in a fasta file, in file order
+    """
+    return [sum(len(l.rstrip()) for l in lines) for _, lines in _records(path)]
+
+
+def balance(lengths, n):
+    """
+    assign items to n groups, longest first to the group with the least in it so far - ties go to the lowest group so the split is always the same
+    """
+    load = [0] * n
+    groups = [None] * len(lengths)
+    for i in sorted(range(len(lengths)), key = lambda i: (-lengths[i], i)):
+        g = min(range(n), key = lambda k: (load[k], k))
+        groups[i] = g
+        load[g] += lengths[i]
+    return groups
+
+
+def split_fasta(path, n, outdir):
+    """
+    split a fasta file into at most n files of whole contigs with similar numbers of bases. Contigs keep their names and are written in their original order, so amrfinder reports the same contig ids and coordinates as it would for the whole assembly.
+    """
+    groups = balance(contig_lengths(path), n)
+    used = sorted(set(groups))
+    paths = {g: pathlib.Path(outdir) / f"chunk_{k}.fa" for k, g in enumerate(used, start = 1)}
+    files = {g: open(p, 'wb') for g, p in paths.items()}
+    try:
+        for g, (header, lines) in zip(groups, _records(path)):
+            files[g].write(header)
+            files[g].writelines(lines)
+    finally:
+        for f in files.values():
+            f.close()
+    return [f"{paths[g]}" for g in used]
+
+
+def merge_outputs(paths, out):
+    """
+    merge the amrfinder outputs of the chunks of an assembly. Rows found in more than one chunk are kept once and rows are sorted on the contig, coordinates and gene so the result does not depend on how the assembly was split.
+    """
+    header = None
+    rows = set()
+    for path in paths:
+        with open(path, 'r') as f:
+            first = f.readline()
+            header = header if header is not None else first
+            rows.update(line.rstrip('\n') + '\n' for line in f if line.strip() != '')
+    cols = header.rstrip('\n').split('\t')
+    idx = [cols.index(c) for c in ['Contig id', 'Start', 'Stop', 'Strand', 'Gene symbol']]
+
+    def key(line):
+        fields = line.rstrip('\n').split('\t')
+        contig, start, stop, strand, gene = [fields[i] for i in idx]
+        return (contig, int(start) if start.isdigit() else 0, int(stop) if stop.isdigit() else 0, strand, gene, line)
+
+    with open(out, 'w') as o:
+        o.write(header)
+        o.writelines(sorted(rows, key = key))
+    return True
+
+
+PACK_TAG = "abritamr{:06d}_"
+PACK_ID = re.compile(r'abritamr(\d{6})_')
+
+
+def pack_fasta(paths, out):
+    """
+    concatenate (possibly compressed) fasta files into one, tagging each contig id with the position of its file so that hits can be traced back to their sample. A file whose last line has no newline is ended with one, so the next header is never joined to its sequence.
+    """
+    last = b'\n'
+    with open(out, 'wb') as o:
+        for n, path in enumerate(paths):
+            tag = PACK_TAG.format(n).encode()
+            with open_contigs(path) as f:
+                for line in f:
+                    if line.startswith(b'>'):
+                        if last != b'\n':
+                            o.write(b'\n')
+                        line = b'>' + tag + line[1:]
+                    o.write(line)
+                    last = line[-1:]
+            if last != b'\n':
+                o.write(b'\n')
+                last = b'\n'
+    return True
+
+
+def demux_output(path, outputs):
+    """
+    split the amrfinder output of a pack into one amrfinder.out per sample, removing the tags from the contig ids. Every output gets the header, so samples without hits have an empty table as they would if run alone.
+    """
+    files = [open(o, 'w') for o in outputs]
+    try:
+        with open(path, 'r') as f:
+            header = f.readline()
+            col = header.rstrip('\n').split('\t').index('Contig id')
+            for o in files:
+                o.write(header)
+            for line in f:
+                fields = line.split('\t')
+                m = PACK_ID.match(fields[col])
+                if m is None or int(m.group(1)) >= len(files):
+                    raise ValueError(f"The contig {fields[col]} in {path} does not belong to any sample of the pack.")
+                fields[col] = fields[col][m.end():]
+                files[int(m.group(1))].write('\t'.join(fields))
+    finally:
+        for o in files:
+            o.close()
+    return True
@@ -0,0 +1,161 @@
+import pathlib, pandas, hashlib, pickle, os, tempfile, logging
+from abritamr.version import db
+from abritamr.Cache import cache_dir
+
+REFGENES = pathlib.Path(__file__).parent / "db" / "refgenes_latest.csv"
+
+# compiled refgenes tables already loaded by this process, keyed on (path, mtime, size)
+_LOADED = {}
+
+
+class RefGenesIndex(object):
+    """
+    A prebuilt lookup over the refgenes table. Each key column is hashed once so that every amrfinder hit can be resolved to a drug class and display name without scanning the table.
+    """
+
+    KEYS = [
+        "allele",
+        "gene_family",
+        "refseq_protein_accession",
+        "genbank_protein_accession",
+        "refseq_nucleotide_accession",
+        "genbank_nucleotide_accession",
+        "synonyms",
+    ]
+    FALLBACK = ['genbank_protein_accession','refseq_nucleotide_accession','genbank_nucleotide_accession']
+
+    def __init__(self, reftab):
+
+        self.reftab = reftab
+        self.subclass = reftab["enhanced_subclass"].tolist()
+        self.allele = reftab["allele"].tolist()
+        self.gene_family = reftab["gene_family"].tolist()
+        self.lookup = {}
+        for col in self.KEYS:
+            positions = {}
+            values = reftab[col].tolist() if col in reftab.columns else []
+            for pos, value in enumerate(values):
+                if pandas.isna(value):
+                    continue
+                # synonyms are a comma separated list of alternative names
+                keys = [v.strip() for v in value.split(",")] if col == "synonyms" else [value]
+                for key in keys:
+                    # keep the first row, as reftab[reftab[col] == key].values[0] would
+                    positions.setdefault(key, pos)
+            self.lookup[col] = positions
+
+    def find(self, value, cols):
+        """
+        return the position of the first refgenes row where value is found, checking cols in order
+        """
+        for col in cols:
+            pos = self.lookup[col].get(value)
+            if pos is not None:
+                return pos
+        return None
+
+    def contains(self, col, value):
+        """
+        is value present in col
+        """
+        return value in self.lookup[col]
+
+    def drugclass(self, value, colname):
+        """
+        return the enhanced subclass for value, falling back on genbank and nucleotide accessions and then 'Unknown'
+        """
+        pos = self.find(value, [colname] + self.FALLBACK)
+        return self.subclass[pos] if pos is not None else 'Unknown'
+
+    def gene_name(self, protein, pointn = False):
+        """
+        return the allele (or gene family if there is no allele) for an accession
+        """
+        suff = f"_POINTN" if pointn else ""
+        protein = protein.split(':')[0] if pointn else protein
+        col ="refseq_nucleotide_accession" if pointn else "refseq_protein_accession"
+        pos = self.find(protein, [col])
+        if pos is not None:
+            if self.allele[pos] != '-':
+                return f"{self.allele[pos]}{suff}"
+            return self.gene_family[pos]
+        pos = self.find(protein, self.FALLBACK)
+        return self.gene_family[pos] if pos is not None else None
+
+    def bifunctional_name(self, protein):
+        """
+        return the joint name of a bifunctional gene
+        """
+        return self.gene_family[self.lookup["refseq_protein_accession"][protein]]
+
+    def resolve(self, gene_symbol, accession, method, pointn = False):
+        """
+        return (enhanced_subclass, display name) for a single amrfinder hit
+        """
+        if self.contains("allele", gene_symbol) and 'POINT' not in method:
+            drugclass = self.drugclass(gene_symbol, "allele")
+            drugname = self.gene_name(protein = accession, pointn = pointn)
+        elif self.contains("allele", gene_symbol) and 'POINT' in method:
+            drugclass = self.drugclass(gene_symbol, "allele")
+            drugname = gene_symbol
+        elif self.contains("gene_family", gene_symbol):
+            drugclass = self.drugclass(accession, "refseq_protein_accession")
+            drugname = self.gene_name(protein = accession)
+            drugname = f"{drugname}*" if not method in ["EXACTX", "ALLELEX"] else f"{drugname}"
+        elif self.contains("refseq_protein_accession", accession):
+            drugclass = self.drugclass(accession, "refseq_protein_accession")
+            drugname = self.bifunctional_name(protein = accession)
+        else:
+            drugname = gene_symbol
+            drugclass = "Unknown"
+
+        return drugclass, drugname
+
+
+def _compile_reftab(path):
+    """
+    parse the refgenes csv and compact repetitive columns to categoricals
+    """
+    reftab = pandas.read_csv(path)
+    reftab = reftab.fillna("-")
+    for col in reftab.columns:
+        if reftab[col].dtype == object or pandas.api.types.is_string_dtype(reftab[col]):
+            if reftab[col].nunique() < len(reftab) / 2:
+                reftab[col] = reftab[col].astype("category")
+    return reftab
+
+
+def load_refgenes(path = REFGENES, db_version = db):
+    """
+    return the RefGenesIndex for path, loaded once per process. The parsed table is stored in a compiled cache keyed on the sha256 of the csv and the DB version so that the csv is only parsed when it changes.
+    """
+    logger = logging.getLogger(__name__)
+    path = pathlib.Path(path)
+    st = path.stat()
+    key = (f"{path.resolve()}", st.st_mtime_ns, st.st_size)
+    if key in _LOADED:
+        return _LOADED[key]
+
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    compiled = cache_dir() / f"refgenes_{db_version}_{digest[:16]}_pandas{pandas.__version__}.pkl"
+    index = None
+    if compiled.exists():
+        try:
+            with open(compiled, "rb") as f:
+                index = pickle.load(f)
+        except Exception:
+            logger.warning(f"The compiled refgenes cache {compiled} could not be read and will be rebuilt.")
+            index = None
+    if index is None:
+        index = RefGenesIndex(_compile_reftab(path))
+        try:
+            compiled.parent.mkdir(parents = True, exist_ok = True)
+            # write to a temporary file then rename so concurrent processes never see a partial cache
+            fd, tmp = tempfile.mkstemp(dir = compiled.parent, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(index, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, compiled)
+        except OSError:
+            logger.warning(f"Unable to write the compiled refgenes cache to {compiled.parent}, refgenes will be parsed on each run.")
+    _LOADED[key] = index
+    return index
@@ -0,0 +1,147 @@
+import csv, math
+import xlsxwriter
+
+
+FORMATS = ['xlsx', 'csv', 'parquet']
+
+
+def frame_rows(df, index = True):
+    """
+    the header and then each row of a dataframe, as lists - laid out as DataFrame.to_excel would, with the index as the first column
+    """
+    header = list(df.columns)
+    if index:
+        header = [df.index.name if df.index.name is not None else ''] + header
+    yield header
+    for row in df.itertuples(index = index, name = None):
+        yield list(row)
+
+
+def _blank(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class _XlsxSink(object):
+    """
+    a single workbook in xlsxwriter's constant memory mode - each row is flushed to disk as soon as the next one is started
+    """
+    def __init__(self, base):
+        self.path = f"{base}.xlsx"
+        self.workbook = xlsxwriter.Workbook(self.path, {'constant_memory': True})
+        # the same look as the pandas header and index cells
+        self.bold = self.workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+
+    def write_sheet(self, name, rows, index = True):
+        sheet = self.workbook.add_worksheet(name)
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row):
+                if _blank(value):
+                    continue
+                if r == 0 or (index and c == 0):
+                    sheet.write(r, c, value, self.bold)
+                else:
+                    sheet.write(r, c, value)
+        return self.path
+
+    def close(self):
+        self.workbook.close()
+
+
+class _CsvSink(object):
+    """
+    a csv file for each sheet
+    """
+    def __init__(self, base):
+        self.base = base
+        self.paths = []
+
+    def _path(self, name, ext):
+        name = name.replace(' ', '_') if name else f"Sheet{len(self.paths) + 1}"
+        return f"{self.base}_{name}.{ext}"
+
+    def write_sheet(self, name, rows, index = True):
+        path = self._path(name, 'csv')
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            for row in rows:
+                writer.writerow(['' if _blank(v) else v for v in row])
+        self.paths.append(path)
+        return path
+
+    def close(self):
+        pass
+
+
+class _ParquetSink(_CsvSink):
+    """
+    a parquet file for each sheet, written in row groups of BATCH rows. All columns are strings, as they are in the spreadsheet.
+    """
+    BATCH = 10000
+
+    def __init__(self, base):
+        super().__init__(base)
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError: # parquet reports are optional
+            raise ImportError("Parquet reports need pyarrow, please install it (pip install pyarrow) or choose another format.")
+        self.pyarrow = pyarrow
+
+    def _flush(self, writer, schema, batch):
+        columns = list(zip(*batch))
+        table = self.pyarrow.Table.from_arrays([self.pyarrow.array(c, type = self.pyarrow.string()) for c in columns], schema = schema)
+        writer.write_table(table)
+
+    def write_sheet(self, name, rows, index = True):
+        path = self._path(name, 'parquet')
+        rows = iter(rows)
+        header = [f"{h}" for h in next(rows)]
+        schema = self.pyarrow.schema([(h if h else f"column_{i}", self.pyarrow.string()) for i, h in enumerate(header)])
+        writer = self.pyarrow.parquet.ParquetWriter(path, schema)
+        try:
+            batch = []
+            for row in rows:
+                batch.append([None if _blank(v) else f"{v}" for v in row])
+                if len(batch) == self.BATCH:
+                    self._flush(writer, schema, batch)
+                    batch = []
+            if batch != []:
+                self._flush(writer, schema, batch)
+        finally:
+            writer.close()
+        self.paths.append(path)
+        return path
+
+
+SINKS = {'xlsx': _XlsxSink, 'csv': _CsvSink, 'parquet': _ParquetSink}
+
+
+class ReportWriter(object):
+    """
+    Write the sheets of a report a row at a time, so that a large run is never held as a whole workbook in memory. Reports are a single xlsx workbook or, for loading into the LIMS, a csv or parquet file for each sheet with the same layout.
+    """
+    def __init__(self, base, fmt = 'xlsx'):
+        if fmt not in SINKS:
+            raise ValueError(f"{fmt} is not a report format, please use one of {', '.join(FORMATS)}.")
+        self.sink = SINKS[fmt](base)
+
+    def write_sheet(self, name, rows, index = True):
+        """
+        write a sheet from an iterable of rows, the first being the header
+        """
+        return self.sink.write_sheet(name, rows, index = index)
+
+    def write_frame(self, name, df, index = True):
+        """
+        write a sheet from a dataframe
+        """
+        return self.write_sheet(name, frame_rows(df, index = index), index = index)
+
+    def close(self):
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
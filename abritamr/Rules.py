@@ -0,0 +1,80 @@
+import re, numpy
+
+# what is done with the genes of a drug class
+REPORT = 'report' # all genes are reportable
+NOT_REPORTED = 'not reported' # no genes are reportable
+INCLUDE = 'include' # only genes matching the pattern are reportable
+EXCLUDE = 'exclude' # genes matching the pattern are not reportable
+
+# MDU general reporting - (drug class, species or genus the rule applies to or None for all, policy, gene pattern). Patterns are matched from the start of the gene name. Drug classes without a rule are not reported.
+GENERAL_RULES = [
+    ("Carbapenemase", None, REPORT, None),
+    ("Carbapenemase (MBL)", None, REPORT, None),
+    # blaL1 is intrinsic to Stenotrophomonas maltophilia
+    ("Carbapenemase (MBL)", "Stenotrophomonas maltophilia", EXCLUDE, r"blaL1"),
+    # KPC and OXA-51 family carbapenemases have never been reported - a missing comma in the original list of reportable classes joined their names. They are kept that way so that reports do not change until the SOP is updated.
+    ("Carbapenemase (KPC variant)", None, NOT_REPORTED, None),
+    ("Carbapenemase (OXA-51 family)", None, NOT_REPORTED, None),
+    ("ESBL", "Salmonella", REPORT, None),
+    ("ESBL (AmpC type)", "Salmonella", REPORT, None),
+    # blaEC is intrinsic to Shigella
+    ("ESBL", "Shigella", EXCLUDE, r".*blaEC"),
+    ("ESBL (AmpC type)", "Shigella", EXCLUDE, r".*blaEC"),
+    ("Aminoglycosides (Ribosomal methyltransferase)", None, REPORT, None),
+    ("Colistin", None, REPORT, None),
+    ("Oxazolidinone & phenicol resistance", None, NOT_REPORTED, None),
+    ("Vancomycin", None, INCLUDE, r"van[A,B,C,D,E,G,L,M,N][\S]*"),
+    ("Methicillin", None, INCLUDE, r"mec[^IR]"),
+]
+
+# other drug classes naming oxazolidinones or linezolid are reported for these species and genera only
+LINEZOLID = re.compile(r"Oxazolidinone|Linezolid")
+LINEZOLID_TAXA = ["Staphylococcus aureus", "Staphylococcus argenteus", "Enterococcus"]
+
+
+class GeneralRules(object):
+    """
+    The MDU general reporting rules compiled into lookup tables. The policy for each drug class and species is worked out once and every gene found in a run is then classed as reportable or not in a single pass.
+    """
+
+    def __init__(self, rules = GENERAL_RULES):
+        self.rules = {}
+        for drugclass, taxon, policy, pattern in rules:
+            self.rules[(drugclass, taxon)] = (policy, re.compile(pattern) if pattern else None)
+        self.classes = {drugclass for drugclass, _ in self.rules}
+        self.policies = {}
+
+    def policy(self, drugclass, species):
+        """
+        the (policy, pattern) for a drug class in a species - a rule for the species is used before one for its genus and then one for all
+        """
+        key = (drugclass, species)
+        if key not in self.policies:
+            genus = f"{species}".split()[0] if f"{species}".split() else ''
+            policy = (NOT_REPORTED, None)
+            if drugclass in self.classes:
+                for taxon in [species, genus, None]:
+                    if (drugclass, taxon) in self.rules:
+                        policy = self.rules[(drugclass, taxon)]
+                        break
+            elif LINEZOLID.search(drugclass) and (species in LINEZOLID_TAXA or genus in LINEZOLID_TAXA):
+                policy = (REPORT, None)
+            self.policies[key] = policy
+        return self.policies[key]
+
+    def reported(self, genes):
+        """
+        a boolean array of whether each gene is reportable - genes is a table with a row per gene found and the columns class, species and gene
+        """
+        # the policy is looked up once for each drug class and species in the run
+        pairs, codes = {}, []
+        for key in zip(genes['class'].tolist(), genes['species'].tolist()):
+            codes.append(pairs.setdefault(key, len(pairs)))
+        codes = numpy.array(codes, dtype = int)
+        rules = [self.policy(drugclass, species) for drugclass, species in pairs]
+        reported = numpy.isin(codes, [i for i, (policy, _) in enumerate(rules) if policy == REPORT])
+        for policy, pattern in set(r for r in rules if r[0] in [INCLUDE, EXCLUDE]):
+            sel = numpy.isin(codes, [i for i, r in enumerate(rules) if r == (policy, pattern)])
+            found = genes['gene'][sel].str.match(pattern.pattern).to_numpy(dtype = bool)
+            reported[sel] = found if policy == INCLUDE else ~found
+        return reported
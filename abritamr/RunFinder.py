@@ -1,25 +1,99 @@
-import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections, re
+import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections, re, time, hashlib, json, tempfile, shutil, contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from abritamr.version import db
-from abritamr.CustomLog import CustomFormatter
+from abritamr.CustomLog import get_logger
+from abritamr.Cache import ResultCache, probe, file_key
+from abritamr.Stage import StagedDB
+from abritamr.Compression import decompressed, READ_ERRORS
+from abritamr.Partition import split_fasta, merge_outputs, pack_fasta, demux_output
+
+
+Job = collections.namedtuple('Job', ['prefix', 'input', 'returncode', 'stderr', 'wall', 'skipped', 'entry', 'cached', 'usage', 'attempts'], defaults = [False, None, False, None, 1])
+Usage = collections.namedtuple('Usage', ['user', 'sys', 'maxrss'])
+
+
+def checksum(path):
+    """
+    sha256 of a file, read in blocks
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Journal(object):
+    """
+    A manifest of completed samples. Each line records the inputs and parameters of a sample and a checksum of its amrfinder.out, so that a restarted run can skip samples that are already done. Samples are appended as they finish and the journal is compacted to one line per sample when it is opened and at the end of each run.
+    """
+    KEYS = ['prefix', 'input', 'input_sha256', 'db_version', 'organism', 'identity']
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.entries = {}
+        self.lines = 0
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    self.lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # a line cut short when a run was killed
+                        continue
+                    self.entries[entry['prefix']] = entry
+            self.compact()
+
+    def record(self, entry):
+        """
+        append a completed sample to the journal
+        """
+        self.entries[entry['prefix']] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+        self.lines += 1
+
+    def compact(self):
+        """
+        rewrite the journal with only the latest entry for each sample, if it has grown past that
+        """
+        if self.lines <= len(self.entries):
+            return False
+        fd, tmp = tempfile.mkstemp(dir = self.path.parent, prefix = f".{self.path.name}.")
+        with os.fdopen(fd, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.path)
+        self.lines = len(self.entries)
+        return True
+
+    def is_complete(self, entry, output):
+        """
+        is there a journal entry with the same inputs and parameters and is the output still intact
+        """
+        done = self.entries.get(entry['prefix'])
+        if done is None or any(done.get(k) != entry.get(k) for k in self.KEYS):
+            return False
+        return pathlib.Path(output).exists() and checksum(output) == done.get('output_sha256')
 
 
 class RunFinder(object):
     """
     A class to run amrfinderplus
     """
+    AMRFINDER = "amrfinder"
+    JOURNAL = "abritamr_journal.jsonl"
+    PLAN = "abritamr_plan.tsv"
+    METRICS = "abritamr_metrics.tsv"
+    TMP_MIN_BYTES = 256 * 1024 ** 2 # the least scratch space a run needs, whatever the size of the assemblies
+    TMP_PER_BASE = 4
+    FAILURES = "abritamr_failures.tsv"
+    RETRY_BACKOFF = 5
+    METRICS_COLS = ['sample', 'input', 'input_bytes', 'bases', 'status', 'returncode', 'threads', 'wall_s', 'user_s', 'sys_s', 'max_rss_kb', 'hits']
+
     def __init__(self, args):
         
-        self.logger =logging.getLogger(__name__) 
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        ch.setFormatter(CustomFormatter())
-        fh = logging.FileHandler('abritamr.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(ch) 
-        self.logger.addHandler(fh)
+        self.logger = get_logger(__name__)
         self.db = db
         self.organism = args.organism
         self.input = args.input
@@ -28,6 +102,17 @@ class RunFinder(object):
         self.prefix = args.prefix
         self.identity = args.identity
         self.amrfinder_db = args.amrfinder_db
+        self.engine = args.engine
+        self.resume = args.resume
+        self.cache = args.cache
+        self.cache_size = args.cache_size
+        self.sizes = args.sizes
+        self.outdir = args.outdir
+        self.chunks = args.chunks
+        self.pack_size = args.pack_size
+        self.stage_db = args.stage_db
+        self.tmpdir = args.tmpdir
+        self.retries = args.retries
 
     def _batch_cmd(self):
         """
@@ -36,7 +121,8 @@ class RunFinder(object):
         org = f"--organism {self.organism}" if self.organism != '' else ''
         d = f" -d {self.amrfinder_db}" if self.amrfinder_db != '' else ''
         _id = f" --ident_min {self.identity} " if self.identity != '' else ''
-        cmd = f"parallel -j {self.jobs} --colsep '\\t' 'mkdir -p {{1}} && amrfinder -n {{2}} -o {{1}}/amrfinder.out --plus {org} --threads 1{d}{_id}' :::: {self.input}"
+        retries = f" --retries {int(self.retries) + 1}" if int(getattr(self, 'retries', 0)) > 0 else ''
+        cmd = f"parallel -j {self.jobs}{retries} --colsep '\\t' 'mkdir -p {{1}} && amrfinder -n {{2}} -o {{1}}/amrfinder.out --plus {org} --threads 1{d}{_id}' :::: {self.input}"
         return cmd
     
     def _single_cmd(self):
@@ -49,6 +135,435 @@ class RunFinder(object):
         cmd = f"mkdir -p {self.prefix} && amrfinder -n {self.input} -o {self.prefix}/amrfinder.out --plus {org} --threads {self.jobs}{d}{_id}"
         return cmd
     
+    def _sample_cmd(self, prefix, contigs, threads = 1, output = None):
+        """
+        generate the amrfinder command for a single sample as a list of arguments for the native engine
+        """
+        output = output if output is not None else f"{prefix}/amrfinder.out"
+        cmd = [self.AMRFINDER, "-n", f"{contigs}", "-o", f"{output}", "--plus"]
+        if self.organism != '':
+            cmd.extend(["--organism", self.organism])
+        cmd.extend(["--threads", f"{threads}"])
+        if self.amrfinder_db:
+            cmd.extend(["-d", f"{self.amrfinder_db}"])
+        if self.identity != '':
+            cmd.extend(["--ident_min", f"{self.identity}"])
+        return cmd
+
+    def _samples(self):
+        """
+        return (prefix, contigs) for each sample to be run
+        """
+        if self.run_type != 'batch':
+            return [(f"{self.prefix}", f"{self.input}")]
+        # ids are kept as written, so that 001 is not read as 1 and still matches the sizes found by setup
+        tab = pandas.read_csv(self.input, sep = '\t', header = None, dtype = str, keep_default_na = False)
+        return [(f"{row[0]}", f"{row[1]}") for row in tab.itertuples(index = False)]
+
+    def _batch_file(self, name):
+        """
+        batch level files sit with the summaries - in the shard directory when running a shard
+        """
+        outdir = getattr(self, 'outdir', '')
+        return f"{outdir}/{name}" if outdir else name
+
+    def _plan(self, samples):
+        """
+        order samples longest first so that the largest assemblies do not finish alone at the end of a batch, and write the plan with the size estimates used
+        """
+        sizes = self.sizes if self.sizes else {}
+        order = sorted(samples, key = lambda s: sizes[s[0]].bases if s[0] in sizes else 0, reverse = True)
+        plan = self._batch_file(self.PLAN) if self.run_type == 'batch' else f"{self.prefix}/{self.PLAN}"
+        with open(plan, 'w') as f:
+            f.write("order\tsample\tinput\tbases\tcontigs\n")
+            for n, (prefix, contigs) in enumerate(order, start = 1):
+                stats = sizes.get(prefix)
+                f.write(f"{n}\t{prefix}\t{contigs}\t{stats.bases if stats else ''}\t{stats.contigs if stats else ''}\n")
+        if sizes:
+            total = sum(s.bases for s in sizes.values())
+            self.logger.info(f"Dispatching {len(order)} samples ({total / 1e6:.1f} Mb) largest first - the plan has been written to {plan}.")
+        return order
+
+    def _tmpdir(self):
+        """
+        the directory for job scratch space - --tmpdir, or the system temporary directory (TMPDIR) if not set
+        """
+        return self.tmpdir if self.tmpdir else tempfile.gettempdir()
+
+    def _job_env(self, jobtmp):
+        """
+        the environment for a job, with every temporary directory variable pointing at its own scratch directory
+        """
+        return dict(os.environ, TMPDIR = jobtmp, TMP = jobtmp, TEMP = jobtmp)
+
+    def _check_tmpdir(self, samples, workers):
+        """
+        check that there is room in the scratch directory for the jobs that will run at once - allow for decompressed inputs and blast and hmmer scratch of a few times the largest assembly. The run only stops for a directory chosen with --tmpdir, the system temporary directory just gets a warning.
+        """
+        tmpdir = self._tmpdir()
+        pathlib.Path(tmpdir).mkdir(parents = True, exist_ok = True)
+        sizes = self.sizes if self.sizes else {}
+        largest = max([sizes[p].bases for p, _ in samples if p in sizes], default = 0)
+        needed = max(self.TMP_MIN_BYTES, workers * self.TMP_PER_BASE * largest)
+        free = shutil.disk_usage(tmpdir).free
+        if free < needed:
+            msg = f"There is not enough space in {tmpdir} for {workers} amrfinder jobs ({free / 1024 ** 3:.1f} GB free, {needed / 1024 ** 3:.1f} GB needed)."
+            if self.tmpdir:
+                self.logger.critical(f"{msg} Please choose another --tmpdir or reduce --jobs.")
+                raise SystemExit
+            self.logger.warning(f"{msg} amrfinder may fail, use --tmpdir to choose another directory if it does.")
+            return False
+        self.logger.info(f"amrfinder jobs will use scratch space in {tmpdir} ({free / 1024 ** 3:.1f} GB free).")
+        return True
+
+    def _retry(self, prefix, run):
+        """
+        call run until amrfinder succeeds or retries is used up, waiting longer between each attempt
+        """
+        job = run()
+        attempt = 1
+        while job.returncode != 0 and attempt <= int(self.retries):
+            wait = self.RETRY_BACKOFF * 2 ** (attempt - 1)
+            self.logger.warning(f"amrfinder failed for {prefix}, it will be tried again in {wait}s (attempt {attempt + 1} of {int(self.retries) + 1}).")
+            time.sleep(wait)
+            job = run()
+            attempt += 1
+        return job._replace(attempts = attempt)
+
+    def _run_sample(self, prefix, contigs, threads = 1, output = None):
+        """
+        run amrfinder on a single sample and return its exit code, stderr, wall time and resource usage - the child is reaped with wait4 so that its cpu time and peak rss can be recorded
+        """
+        pathlib.Path(prefix).mkdir(parents = True, exist_ok = True)
+        start = time.monotonic()
+        usage = None
+        # each job gets its own scratch directory, used by amrfinder and the tools it runs through TMPDIR
+        jobtmp = tempfile.mkdtemp(dir = self._tmpdir(), prefix = "abritamr_job.")
+        try:
+            with tempfile.TemporaryFile(mode = 'w+', encoding = 'utf-8', dir = jobtmp) as err:
+                try:
+                    with decompressed(contigs, tmpdir = jobtmp) as path:
+                        cmd = self._sample_cmd(prefix = prefix, contigs = path, threads = threads, output = output)
+                        self.logger.debug(f"Now executing : {' '.join(cmd)}")
+                        p = subprocess.Popen(cmd, stdout = subprocess.DEVNULL, stderr = err, env = self._job_env(jobtmp))
+                        _, status, rusage = os.wait4(p.pid, 0)
+                    p.returncode = returncode = os.waitstatus_to_exitcode(status)
+                    usage = Usage(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+                except READ_ERRORS as e:
+                    # amrfinder could not be started or the assembly could not be decompressed - the sample fails on its own
+                    returncode = 127
+                    err.write(f"{e}")
+                err.seek(0)
+                stderr = err.read()
+        finally:
+            shutil.rmtree(jobtmp, ignore_errors = True)
+        return Job(prefix, contigs, returncode, stderr, time.monotonic() - start, usage = usage)
+
+    def _db_version(self):
+        """
+        the version of the amrfinder DB in use - from version.txt if it can be found
+        """
+        version = pathlib.Path(f"{self.amrfinder_db}") / 'version.txt' if self.amrfinder_db else None
+        if version is not None and version.exists():
+            return version.read_text().strip()
+        return f"{self.amrfinder_db}" if self.amrfinder_db else self.db
+
+    def _journal_path(self):
+        """
+        batch journals sit with the summaries, single sample journals in the output directory
+        """
+        return self._batch_file(self.JOURNAL) if self.run_type == 'batch' else f"{self.prefix}/{self.JOURNAL}"
+
+    def _journal_entry(self, prefix, contigs):
+        """
+        the inputs and parameters that determine the amrfinder output of a sample
+        """
+        return {
+            'prefix': prefix,
+            'input': contigs,
+            'input_sha256': checksum(contigs) if pathlib.Path(contigs).exists() else '',
+            'db_version': self._db_version(),
+            'organism': self.organism,
+            'identity': f"{self.identity}"
+        }
+
+    def _amrfinder_key(self):
+        """
+        identifies the amrfinder in use and its default DB, so that probes of it are only run again when either changes
+        """
+        exe = shutil.which(self.AMRFINDER)
+        if exe is None:
+            return None
+        latest = pathlib.Path(os.path.realpath(exe)).parent.parent / 'share' / 'amrfinderplus' / 'data' / 'latest'
+        return f"{file_key(exe)}|{file_key(latest)}"
+
+    def _amrfinder_version(self):
+        """
+        the version of amrfinder on the PATH, or '' if it can not be determined
+        """
+        if getattr(self, '_version', None) is None:
+            def version():
+                try:
+                    p = subprocess.run([self.AMRFINDER, "--version"], capture_output = True, encoding = "utf-8")
+                    return p.stdout.strip() if p.returncode == 0 else ''
+                except OSError:
+                    return ''
+            self._version = probe('amrfinder_version', self._amrfinder_key(), version)
+        return self._version
+
+    def _result_cache(self):
+        """
+        the shared amrfinder result cache, or None if it is not in use
+        """
+        if not self.cache:
+            return None
+        if getattr(self, '_cache', None) is None:
+            self._cache = ResultCache(self.cache, int(float(self.cache_size) * 1024 ** 3))
+        return self._cache
+
+    def _lookup_sample(self, prefix, contigs, journal = None):
+        """
+        return a finished Job if a sample does not need to be run - it is complete in the journal (when resuming) or its result is in the cache - along with its journal entry and cache key
+        """
+        entry = self._journal_entry(prefix, contigs)
+        output = f"{prefix}/amrfinder.out"
+        if self.resume and journal is not None and journal.is_complete(entry, output):
+            return Job(prefix, contigs, 0, '', 0.0, True, entry), entry, None
+        cache = self._result_cache() if entry['input_sha256'] != '' else None
+        key = cache.key(entry['input_sha256'], entry['db_version'], self.organism, self.identity, self._amrfinder_version()) if cache else None
+        pathlib.Path(prefix).mkdir(parents = True, exist_ok = True)
+        if cache is not None and cache.get(key, output):
+            entry['output_sha256'] = checksum(output)
+            return Job(prefix, contigs, 0, '', 0.0, False, entry, True), entry, key
+        return None, entry, key
+
+    def _store_sample(self, job, entry, key, cache = True):
+        """
+        checksum the output of a sample that has been run and add it to the cache
+        """
+        output = f"{job.prefix}/amrfinder.out"
+        if job.returncode == 0 and pathlib.Path(output).exists():
+            entry['output_sha256'] = checksum(output)
+            if cache and key is not None:
+                self._result_cache().put(key, output)
+        return job._replace(entry = entry)
+
+    def _process_sample(self, prefix, contigs, threads = 1, journal = None):
+        """
+        run a single sample, unless resuming and the journal shows it is already complete or the result is in the cache
+        """
+        done, entry, key = self._lookup_sample(prefix, contigs, journal)
+        if done is not None:
+            return done
+        chunked = self.run_type != 'batch' and int(self.chunks) > 1
+        job = self._retry(prefix, lambda: self._run_chunked(prefix, contigs, threads) if chunked else self._run_sample(prefix, contigs, threads))
+        # a chunked run has the same hits but is only cached from whole assemblies
+        return self._store_sample(job, entry, key, cache = not chunked)
+
+    def _packs(self, samples):
+        """
+        group samples, in the order planned, into packs of up to pack_size Mb to be run by a single amrfinder. Samples of unknown size or larger than a pack are run alone.
+        """
+        limit = float(self.pack_size) * 1e6
+        sizes = self.sizes if self.sizes else {}
+        packs, current, total = [], [], 0
+        for prefix, contigs in samples:
+            bases = sizes[prefix].bases if prefix in sizes else None
+            if bases is None or bases >= limit:
+                packs.append([(prefix, contigs)])
+                continue
+            if current != [] and total + bases > limit:
+                packs.append(current)
+                current, total = [], 0
+            current.append((prefix, contigs))
+            total += bases
+        if current != []:
+            packs.append(current)
+        return packs
+
+    def _process_pack(self, pack, journal = None, threads = 1):
+        """
+        run a pack of samples with a single amrfinder - contigs are tagged with their sample, the output is split back into an amrfinder.out for each sample. If the pack fails its samples are run one at a time.
+        """
+        if len(pack) == 1:
+            return [self._process_sample(pack[0][0], pack[0][1], threads, journal)]
+        jobs, todo = [], []
+        for prefix, contigs in pack:
+            done, entry, key = self._lookup_sample(prefix, contigs, journal)
+            if done is not None:
+                jobs.append(done)
+            else:
+                todo.append((prefix, contigs, entry, key))
+        if len(todo) < 2:
+            return jobs + [self._store_sample(self._retry(prefix, lambda: self._run_sample(prefix, contigs)), entry, key) for prefix, contigs, entry, key in todo]
+        workdir = tempfile.mkdtemp(dir = self._tmpdir(), prefix = "abritamr_pack.")
+        try:
+            try:
+                pack_fasta([contigs for _, contigs, _, _ in todo], f"{workdir}/pack.fa")
+            except READ_ERRORS as e:
+                # one of the assemblies could not be read, running them one at a time finds which
+                packed = Job(workdir, f"{workdir}/pack.fa", 1, f"{e}", 0)
+            else:
+                packed = self._run_sample(workdir, f"{workdir}/pack.fa", 1, output = f"{workdir}/pack.out")
+                if packed.returncode == 0:
+                    demux_output(f"{workdir}/pack.out", [f"{prefix}/amrfinder.out" for prefix, _, _, _ in todo])
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
+        if packed.returncode != 0:
+            self.logger.warning(f"amrfinder failed for a pack of {len(todo)} samples, they will be run one at a time.")
+            return jobs + [self._store_sample(self._retry(prefix, lambda: self._run_sample(prefix, contigs)), entry, key) for prefix, contigs, entry, key in todo]
+        # the time and cpu of the pack are shared between its samples by size, the peak memory is that of the pack
+        sizes = self.sizes if self.sizes else {}
+        bases = [sizes[prefix].bases if prefix in sizes else 0 for prefix, _, _, _ in todo]
+        for (prefix, contigs, entry, key), b in zip(todo, bases):
+            share = b / sum(bases) if sum(bases) > 0 else 1 / len(todo)
+            usage = Usage(packed.usage.user * share, packed.usage.sys * share, packed.usage.maxrss) if packed.usage else None
+            jobs.append(self._store_sample(Job(prefix, contigs, 0, '', packed.wall * share, usage = usage), entry, key))
+        return jobs
+
+    def _run_chunked(self, prefix, contigs, threads = 1):
+        """
+        split an assembly into chunks of whole contigs, run amrfinder on the chunks at the same time and merge the hits into a single amrfinder.out
+        """
+        start = time.monotonic()
+        workdir = tempfile.mkdtemp(prefix = "chunks.", dir = prefix)
+        # a compressed assembly is decompressed in node local scratch, as it is for a single job
+        jobtmp = tempfile.mkdtemp(dir = self._tmpdir(), prefix = "abritamr_job.")
+        try:
+            try:
+                with decompressed(contigs, tmpdir = jobtmp) as path:
+                    chunks = split_fasta(path, int(self.chunks), workdir)
+            except READ_ERRORS as e:
+                return Job(prefix, contigs, 127, f"{e}", time.monotonic() - start)
+            if chunks == []:
+                return self._run_sample(prefix, contigs, threads)
+            per_chunk = max(1, int(threads) // len(chunks))
+            self.logger.info(f"{prefix} has been split into {len(chunks)} chunks of contigs, each run with {per_chunk} threads.")
+            with ThreadPoolExecutor(max_workers = len(chunks)) as pool:
+                jobs = list(pool.map(lambda c: self._run_sample(prefix, c, per_chunk, output = f"{c}.out"), chunks))
+            failed = [job for job in jobs if job.returncode != 0]
+            if failed == []:
+                merge_outputs([f"{c}.out" for c in chunks], f"{prefix}/amrfinder.out")
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
+            shutil.rmtree(jobtmp, ignore_errors = True)
+        used = [job.usage for job in jobs if job.usage is not None]
+        usage = Usage(sum(u.user for u in used), sum(u.sys for u in used), max(u.maxrss for u in used)) if used else None
+        returncode = failed[0].returncode if failed else 0
+        stderr = ''.join(job.stderr for job in failed)
+        return Job(prefix, contigs, returncode, stderr, time.monotonic() - start, usage = usage)
+
+    def _metrics_path(self):
+        """
+        batch metrics sit with the summaries, single sample metrics in the output directory
+        """
+        return self._batch_file(self.METRICS) if self.run_type == 'batch' else f"{self.prefix}/{self.METRICS}"
+
+    def _open_metrics(self):
+        """
+        start the per sample metrics table for this run
+        """
+        f = open(self._metrics_path(), 'w')
+        f.write("\t".join(self.METRICS_COLS) + "\n")
+        return f
+
+    def _count_hits(self, output):
+        """
+        the number of hits in an amrfinder output
+        """
+        if not pathlib.Path(output).exists():
+            return ''
+        with open(output, 'r') as f:
+            return max(sum(1 for line in f) - 1, 0)
+
+    def _record_metrics(self, metrics, job, threads = 1):
+        """
+        write a row of the metrics table for a finished sample
+        """
+        sizes = self.sizes if self.sizes else {}
+        stats = sizes.get(job.prefix)
+        path = pathlib.Path(job.input)
+        status = 'skipped' if job.skipped else 'cached' if job.cached else 'completed' if job.returncode == 0 else 'failed'
+        usage = job.usage
+        row = [
+            job.prefix,
+            job.input,
+            path.stat().st_size if path.exists() else '',
+            stats.bases if stats else '',
+            status,
+            job.returncode,
+            threads,
+            f"{job.wall:.3f}",
+            f"{usage.user:.3f}" if usage else '',
+            f"{usage.sys:.3f}" if usage else '',
+            usage.maxrss if usage else '',
+            self._count_hits(f"{job.prefix}/amrfinder.out") if job.returncode == 0 else ''
+        ]
+        metrics.write("\t".join(f"{r}" for r in row) + "\n")
+        metrics.flush()
+
+    def _log_usage(self):
+        """
+        log the total cpu time and largest peak memory of the amrfinder jobs that were run
+        """
+        used = [job for job in self.results.values() if job.usage is not None]
+        if used:
+            cpu = sum(job.usage.user + job.usage.sys for job in used)
+            peak = max(used, key = lambda job: job.usage.maxrss)
+            self.logger.info(f"amrfinder used {cpu:.1f}s of cpu over {len(used)} samples, the largest peak memory was {peak.usage.maxrss / 1024:.0f} Mb ({peak.prefix}). Per sample metrics have been written to {self._metrics_path()}.")
+
+    def _run_native(self, on_complete = None):
+        """
+        run amrfinder for each sample in a pool of at most jobs workers. Each sample is handed to on_complete as soon as it finishes.
+        """
+        if self.run_type != 'batch':
+            pathlib.Path(self.prefix).mkdir(parents = True, exist_ok = True)
+        samples = self._plan(self._samples())
+        threads = int(self.jobs) if self.run_type != 'batch' else 1
+        journal = Journal(self._journal_path())
+        metrics = self._open_metrics()
+        self.results = {}
+        skipped = 0
+        cached = 0
+        n = 0
+        if self.run_type == 'batch' and float(self.pack_size) > 0:
+            packs = self._packs(samples)
+            self.logger.info(f"{len(samples)} samples have been grouped into {len(packs)} packs of up to {self.pack_size} Mb.")
+            units = [(self._process_pack, pack, journal) for pack in packs]
+        else:
+            units = [(self._process_pack, [(prefix, contigs)], journal, threads) for prefix, contigs in samples]
+        workers = max(1, min(int(self.jobs), len(units)))
+        self._check_tmpdir(samples, workers)
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            futures = [pool.submit(*unit) for unit in units]
+            for job in (job for future in as_completed(futures) for job in future.result()):
+                n += 1
+                self.results[job.prefix] = job
+                if job.skipped:
+                    skipped += 1
+                    self.logger.debug(f"{job.prefix} is unchanged since it was last run and will not be run again.")
+                elif job.returncode == 0:
+                    if job.cached:
+                        cached += 1
+                        self.logger.debug(f"The result for {job.prefix} was found in the cache ({n} of {len(samples)}).")
+                    else:
+                        self.logger.debug(f"AMRfinder completed for {job.prefix} in {job.wall:.1f}s ({n} of {len(samples)}).")
+                    if 'output_sha256' in job.entry:
+                        journal.record(job.entry)
+                else:
+                    self.logger.warning(f"amrfinder failed for {job.prefix} after {job.attempts} attempt(s) and it will be left out of the summaries. The following error has been reported : \n {job.stderr}")
+                self._record_metrics(metrics, job, threads)
+                if on_complete is not None:
+                    on_complete(job)
+        metrics.close()
+        journal.compact()
+        if skipped:
+            self.logger.info(f"{skipped} of {len(samples)} samples were already complete and have been skipped.")
+        done = sum(job.returncode == 0 and not job.skipped for job in self.results.values())
+        self.logger.info(f"AMRfinder completed for {done} of {len(samples)} samples{f' ({cached} found in the cache)' if cached else ''}.")
+        self._log_usage()
+        return all(job.returncode == 0 for job in self.results.values())
+
     def _check_amrfinder(self):
         """
         Check that amrfinder is installed and db setup properly.
@@ -57,10 +572,12 @@ class RunFinder(object):
         self.logger.info(f"Checking for amrfinder DB: {self.amrfinder_db} and comparing it to {self.db}")
         if self.amrfinder_db == '' or self.amrfinder_db == None:
             self.logger.warning(f"It seems you don't have the AMRFINDER_DB variable set. Now checking AMRfinder setup. Please note if the AMRFinder DB is not v {self.db} this may cause errors")
-            cmd = f"amrfinder --help"
-            pat = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,2})?')
-            p = subprocess.run(cmd, shell = True, encoding = "utf-8", capture_output = True)
-            m = re.search(r'[0-9]{4}-[0-9]{2}-[0-9]{2}', p.stderr)
+            cmd = f"{self.AMRFINDER} --help"
+            def db_date():
+                p = subprocess.run(cmd, shell = True, encoding = "utf-8", capture_output = True)
+                m = re.search(r'[0-9]{4}-[0-9]{2}-[0-9]{2}', p.stderr)
+                return m.group(0) if m else ''
+            m = probe('amrfinder_db_date', self._amrfinder_key(), db_date)
             
             if m:
                 ok = True
@@ -87,7 +604,8 @@ class RunFinder(object):
         Use subprocess to run the command for amrfinder
         """
 
-        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8")
+        env = dict(os.environ, TMPDIR = self.tmpdir) if self.tmpdir else None
+        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", env = env)
         if p.returncode == 0:
             self.logger.info(f"AMRfinder completed successfully. Will now move on to collation.")
             return True
@@ -104,21 +622,72 @@ class RunFinder(object):
         else:
             return True
 
+    def _quarantine(self, failed, total):
+        """
+        record the samples that amrfinder failed for in the failures report, so that they are left out of collation and can be looked at and rerun. The report is removed when nothing failed.
+        """
+        path = self._batch_file(self.FAILURES)
+        if failed == []:
+            pathlib.Path(path).unlink(missing_ok = True)
+            return True
+        if len(failed) == total:
+            self.logger.critical(f"amrfinder failed for all {total} samples. Please check all inputs and the abritamr log and try again.")
+            raise SystemExit
+        with open(path, 'w') as f:
+            f.write('\t'.join(['Isolate', 'Contigs', 'Attempts', 'Returncode', 'Error']) + '\n')
+            for job in failed:
+                error = ' '.join(f"{job.stderr}".split())
+                f.write('\t'.join([f"{job.prefix}", f"{job.input}", f"{job.attempts}", f"{job.returncode}", error]) + '\n')
+        self.logger.warning(f"amrfinder failed for {len(failed)} of {total} samples, they have been left out of the summaries and listed in {path}.")
+        return True
+
     def _check_outputs(self):
         """
-        use inputs to check if files made
+        use inputs to check if files made - in batch mode samples that failed are quarantined rather than stopping the run
         """
         if self.run_type != 'batch':
             self._check_output_file(f"{self.prefix}/amrfinder.out")
+            return True
+        failed = []
+        if getattr(self, 'results', None):
+            # the native engine already knows which samples were run and how they went
+            for prefix, job in self.results.items():
+                if job.returncode != 0:
+                    failed.append(job)
+                else:
+                    self._check_output_file(f"{prefix}/amrfinder.out")
+            total = len(self.results)
         else:
-            tab = pandas.read_csv(self.input, sep = '\t', header = None)
-            for row in tab.iterrows():
-                self._check_output_file(f"{row[1][0]}/amrfinder.out")
-        return True
+            samples = self._samples()
+            for prefix, contigs in samples:
+                if not pathlib.Path(f"{prefix}/amrfinder.out").exists():
+                    failed.append(Job(prefix, contigs, '', 'amrfinder.out is missing', 0, attempts = int(getattr(self, 'retries', 0)) + 1))
+            total = len(samples)
+        return self._quarantine(failed, total)
 
-    def run(self):
+    @contextlib.contextmanager
+    def _staged_db(self):
         """
-        run amrfinder
+        point amrfinder at a copy of the DB on node local storage for the duration of the run, if requested
+        """
+        if not self.stage_db:
+            yield
+            return
+        if not self.amrfinder_db:
+            self.logger.warning(f"--stage_db needs the path of the amrfinder DB (-d), the default DB will be used in place.")
+            yield
+            return
+        source = self.amrfinder_db
+        with StagedDB(source, self.stage_db) as staged:
+            self.amrfinder_db = staged
+            try:
+                yield
+            finally:
+                self.amrfinder_db = source
+
+    def run(self, on_complete = None):
+        """
+        run amrfinder - on_complete is called with each finished sample when using the native engine
         """
         if self._check_amrfinder():
             self.logger.info(f"All check complete now running AMRFinder")
@@ -127,9 +696,18 @@ class RunFinder(object):
         else:
             self.logger.critical(f"Your amrfinder database version is NOT {self.db}. abriTAMR will still run but behaviour may not be as expected in terms of binnig genes into the appropriate drug classes.")
             # raise SystemExit
-        cmd = self._generate_cmd()
-        self.logger.info(f"You are running abritamr in {self.run_type} mode. Now executing : {cmd}")
-        self._run_cmd(cmd)
+        with self._staged_db():
+            if self.engine == 'parallel':
+                if self.resume:
+                    self.logger.warning(f"--resume is only supported by the native engine, all samples will be run.")
+                if int(self.chunks) > 1:
+                    self.logger.warning(f"--chunks is only supported by the native engine, the assembly will be run whole.")
+                cmd = self._generate_cmd()
+                self.logger.info(f"You are running abritamr in {self.run_type} mode. Now executing : {cmd}")
+                self._run_cmd(cmd)
+            else:
+                self.logger.info(f"You are running abritamr in {self.run_type} mode with up to {self.jobs} amrfinder jobs at a time.")
+                self._run_native(on_complete = on_complete)
         self._check_outputs()
         Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix'])
         amr_data = Data(self.run_type, self.input, self.prefix)
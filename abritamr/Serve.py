@@ -0,0 +1,145 @@
+import pathlib, os, json, socket, socketserver, logging, copy, argparse
+from concurrent.futures import ThreadPoolExecutor
+from abritamr.CustomLog import get_logger
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    read a single json submission and reply with a single json result
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            result = {'status': 'error', 'message': 'The submission could not be read, it should be a single line of json.'}
+        else:
+            try:
+                result = self.server.service.submit(request).result()
+            except Exception as e:
+                self.server.service.logger.exception(f"The submission {request} failed.")
+                result = {'status': 'error', 'message': f"{e}"}
+        self.wfile.write((json.dumps(result) + "\n").encode())
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Service(object):
+    """
+    A long running abritamr that keeps refgenes, the checked amrfinder setup and a pool of workers ready between submissions. Submissions are single samples sent as a line of json over a unix socket, the collated results are returned as json and the usual outputs are saved in the prefix directory.
+    """
+
+    def __init__(self, args):
+        self.logger = get_logger(__name__)
+        self.socket = args.socket
+        self.workers = int(args.workers)
+        self.defaults = argparse.Namespace(
+            contigs = '', prefix = '', jobs = args.jobs, species = '', identity = '', amrfinder_db = args.amrfinder_db,
+            engine = 'native', resume = False, cache = args.cache, cache_size = args.cache_size, shard = '', chunks = args.chunks, pack_size = 0, stage_db = '', tmpdir = '', retries = 0
+        )
+
+    def warm(self):
+        """
+        load refgenes, check amrfinder and build the objects that each submission is copied from
+        """
+        # imported here so that the client (submit) does not pay for pandas
+        from abritamr.AmrSetup import SetupAMR
+        from abritamr.RunFinder import RunFinder
+        from abritamr.Collate import Collate
+        from abritamr.RefGenes import load_refgenes
+        load_refgenes(Collate.REFGENES)
+        self.setup = SetupAMR(self.defaults)
+        data = dict(vars(self.defaults), run_type = 'assembly', input = '', organism = '', sizes = {}, outdir = '')
+        self.runner = RunFinder(argparse.Namespace(**data))
+        if not self.runner._check_amrfinder():
+            self.logger.critical(f"Your amrfinder database version is NOT {self.runner.db}. abriTAMR will still run but behaviour may not be as expected in terms of binnig genes into the appropriate drug classes.")
+        self.runner._amrfinder_version()
+        self.collator = Collate(argparse.Namespace(**data))
+        self.pool = ThreadPoolExecutor(max_workers = self.workers)
+        self.logger.info(f"abritamr is ready for up to {self.workers} samples at a time.")
+
+    def submit(self, request):
+        """
+        queue a submission on the worker pool
+        """
+        return self.pool.submit(self.run_sample, request)
+
+    def run_sample(self, request):
+        """
+        validate, run and collate a single sample - returns the collated rows
+        """
+        for key in ['contigs', 'prefix']:
+            if not pathlib.Path(f"{request.get(key, '')}").is_absolute():
+                return {'status': 'error', 'message': f"{key} must be an absolute path."}
+        setup = copy.copy(self.setup)
+        setup.contigs = request['contigs']
+        setup.prefix = request['prefix']
+        setup.species = request.get('species', '') if request.get('species', '') in setup.species_list else ''
+        setup.identity = request.get('identity', '')
+        try:
+            data = setup.setup()
+        except (SystemExit, OSError):
+            return {'status': 'error', 'message': f"{request['contigs']} could not be validated, please check the abritamr log."}
+        if data.run_type != 'assembly':
+            return {'status': 'error', 'message': f"Only single samples can be submitted, run batches with abritamr run."}
+        # share the checked setup and amrfinder version but nothing that belongs to another submission
+        runner = copy.copy(self.runner)
+        runner.__dict__.update(data._asdict())
+        collator = copy.copy(self.collator)
+        collator.__dict__.update(prefix = data.prefix, run_type = data.run_type, input = data.input, collected = {})
+        self.logger.info(f"Running {data.prefix}")
+        runner._run_native(on_complete = collator.collect_job)
+        job = runner.results[data.prefix]
+        if job.returncode != 0:
+            return {'status': 'error', 'message': f"amrfinder failed for {data.prefix} : {job.stderr}"}
+        collator.run()
+        match, partial, virulence = [next(collator._wide_records(summary)) for summary in collator.summaries]
+        return {'status': 'ok', 'prefix': data.prefix, 'matches': match, 'partials': partial, 'virulence': virulence}
+
+    def _listening(self, path):
+        """
+        is a server already accepting connections on path
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(f"{path}")
+            except OSError:
+                return False
+        return True
+
+    def run(self):
+        path = pathlib.Path(self.socket)
+        if path.exists():
+            if self._listening(path):
+                self.logger.critical(f"Another abritamr serve is already listening on {path}. Please stop it or use another --socket.")
+                raise SystemExit
+            # left behind by a server that did not shut down cleanly
+            path.unlink()
+        self.warm()
+        # the socket is created owner only, there is no window where others could connect
+        umask = os.umask(0o177)
+        try:
+            server = _Server(f"{path}", _Handler)
+        finally:
+            os.umask(umask)
+        server.service = self
+        self.logger.info(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            path.unlink(missing_ok = True)
+            self.pool.shutdown()
+
+
+def submit(path, request):
+    """
+    send a submission to a running abritamr service and return its reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(f"{path}")
+        s.sendall((json.dumps(request) + "\n").encode())
+        with s.makefile('r') as f:
+            return json.loads(f.readline())
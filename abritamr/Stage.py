@@ -0,0 +1,133 @@
+import pathlib, os, shutil, tempfile, fcntl, hashlib, json, logging
+
+
+class StagedDB(object):
+    """
+    A copy of the amrfinder DB on node local storage, shared by every abritamr on the node. The copy is made (or hard linked when on the same filesystem) once under a lock, checked against version.txt, read into the page cache and removed when the last abritamr using it has finished.
+    """
+
+    def __init__(self, source, scratch):
+        self.logger = logging.getLogger(__name__)
+        self.source = pathlib.Path(source)
+        self.scratch = pathlib.Path(scratch)
+        self.version = self._version(self.source)
+        name = hashlib.sha256(f"{self.source.resolve()}".encode()).hexdigest()[:12]
+        if self.version == '':
+            # without version.txt a stage left by another run can not be told apart from a changed DB, so it is not shared
+            name = f"{name}_pid{os.getpid()}"
+        # the version is kept in the name so the staged path still identifies the DB
+        self.path = self.scratch / f"abritamr_db_{self.version}_{name}"
+        self.lockfile = self.scratch / f"{self.path.name}.lock"
+        self.users = self.scratch / f"{self.path.name}.users"
+
+    def _version(self, path):
+        version = pathlib.Path(path) / 'version.txt'
+        return version.read_text().strip() if version.exists() else ''
+
+    def _files(self, root):
+        return sorted(p.relative_to(root) for p in pathlib.Path(root).rglob('*') if p.is_file())
+
+    def _is_current(self):
+        """
+        is the staged copy complete and the same version as the source
+        """
+        if not self.path.is_dir() or self._version(self.path) != self.version:
+            return False
+        staged = {f: (self.path / f).stat().st_size for f in self._files(self.path)}
+        return all(staged.get(f) == (self.source / f).stat().st_size for f in self._files(self.source))
+
+    def _stage(self):
+        """
+        copy the DB into a temporary directory beside the target and rename it into place
+        """
+        tmp = pathlib.Path(tempfile.mkdtemp(dir = self.scratch, prefix = f".{self.path.name}."))
+        linked = 0
+        try:
+            for f in self._files(self.source):
+                (tmp / f).parent.mkdir(parents = True, exist_ok = True)
+                try:
+                    os.link(self.source / f, tmp / f)
+                    linked += 1
+                except OSError:
+                    shutil.copy2(self.source / f, tmp / f)
+        except OSError as e:
+            # a partial copy on /dev/shm would hold on to the node's memory
+            shutil.rmtree(tmp, ignore_errors = True)
+            self.logger.critical(f"The amrfinder DB could not be staged in {self.scratch} ({e}). Please check the space available there or run without --stage_db.")
+            raise SystemExit
+        if self._version(tmp) != self.version:
+            shutil.rmtree(tmp, ignore_errors = True)
+            self.logger.critical(f"The staged amrfinder DB in {tmp} does not match {self.source}/version.txt. Please check the DB and {self.scratch}.")
+            raise SystemExit
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        os.replace(tmp, self.path)
+        self.logger.info(f"The amrfinder DB {self.version} has been staged in {self.path}{' (hard linked)' if linked else ''}.")
+
+    def _prefault(self):
+        """
+        read the staged DB once so that its pages are in the page cache before amrfinder starts
+        """
+        for f in self._files(self.path):
+            with open(self.path / f, 'rb') as fh:
+                while fh.read(1 << 22):
+                    pass
+
+    def _read_users(self):
+        try:
+            users = json.loads(self.users.read_text())
+        except (OSError, ValueError):
+            return {}
+        # forget processes that have gone without cleaning up
+        live = {}
+        for pid, n in users.items():
+            try:
+                os.kill(int(pid), 0)
+                live[pid] = n
+            except ProcessLookupError:
+                continue
+            except PermissionError:
+                live[pid] = n
+        return live
+
+    def _write_users(self, users):
+        self.users.write_text(json.dumps(users))
+
+    def __enter__(self):
+        if self.version == '':
+            self.logger.warning(f"{self.source} has no version.txt, so its staged copy can not be checked against it and will not be shared with other runs.")
+        self.scratch.mkdir(parents = True, exist_ok = True)
+        with open(self.lockfile, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not self._is_current():
+                    self._stage()
+                else:
+                    self.logger.info(f"Using the amrfinder DB already staged in {self.path}.")
+                users = self._read_users()
+                pid = f"{os.getpid()}"
+                users[pid] = users.get(pid, 0) + 1
+                self._write_users(users)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._prefault()
+        return f"{self.path}"
+
+    def __exit__(self, *exc):
+        with open(self.lockfile, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                users = self._read_users()
+                pid = f"{os.getpid()}"
+                users[pid] = users.get(pid, 1) - 1
+                if users[pid] <= 0:
+                    users.pop(pid)
+                if users == {}:
+                    shutil.rmtree(self.path, ignore_errors = True)
+                    self.users.unlink(missing_ok = True)
+                    self.logger.info(f"Removed the staged amrfinder DB {self.path}.")
+                else:
+                    self._write_users(users)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
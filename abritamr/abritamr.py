@@ -1,8 +1,5 @@
-import pathlib, argparse, sys, os, logging
+import pathlib, argparse, sys, os, logging, json
 
-from abritamr.AmrSetup import SetupAMR, SetupMDU
-from abritamr.RunFinder import RunFinder
-from abritamr.Collate import Collate, MduCollate
 from abritamr.version import __version__, db
 
 """
@@ -12,16 +9,56 @@ abritamr is designed to implement AMRFinder and parse the results compatible for
 
 def run_pipeline(args):
 
+    if args.server != '':
+        return run_client(args)
+    # pandas and friends are only imported once a subcommand needs them, so that --help and --version are quick
+    from abritamr.AmrSetup import SetupAMR
+    from abritamr.RunFinder import RunFinder
+    from abritamr.Collate import Collate
     P = SetupAMR(args)
     input_data = P.setup()
     A = RunFinder(input_data)
-    amr_data = A.run()
-    C = Collate(amr_data)
+    C = Collate(input_data)
+    # with the native engine the hits of each sample are read as soon as amrfinder finishes with it
+    amr_data = A.run(on_complete = C.collect_job if input_data.engine != 'parallel' else None)
     C.run()
     
 
+def run_client(args):
+    """
+    submit a single sample to a running abritamr serve and print the collated result
+    """
+    from abritamr.Serve import submit
+    request = {
+        'contigs': f"{pathlib.Path(args.contigs).resolve()}",
+        'prefix': f"{pathlib.Path(args.prefix).resolve()}",
+        'species': args.species,
+        'identity': args.identity
+    }
+    result = submit(args.server, request)
+    print(json.dumps(result, indent = 2))
+    if result['status'] != 'ok':
+        raise SystemExit(1)
+
+
+def serve(args):
+
+    from abritamr.Serve import Service
+    S = Service(args)
+    S.run()
+
+
+def merge(args):
+
+    from abritamr.Collate import MergeShards
+    M = MergeShards(args)
+    M.run()
+
+
 def mdu(args):
     
+    from abritamr.AmrSetup import SetupMDU
+    from abritamr.Collate import MduCollate
     M = SetupMDU(args)
     input_data = M.setup()
     C = MduCollate(input_data)
@@ -33,6 +70,7 @@ def main():
         description=f"****AMR gene detection pipeline - version {__version__}****", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
+    parser.add_argument('--debug', action='store_true', help='Also write debug messages (one or more per sample) to abritamr.log. Setting ABRITAMR_DEBUG=1 does the same.')
     
     subparsers = parser.add_subparsers(help="Task to perform")
     parser_sub_run = subparsers.add_parser('run', help='Run abritamr', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -40,7 +78,7 @@ def main():
         "--contigs",
         "-c",
         default="",
-        help="Tab-delimited file with sample ID as column 1 and path to assemblies as column 2 OR path to a contig file (used if only doing a single sample - should provide value for -pfx). ",
+        help="Tab-delimited file with sample ID as column 1 and path to assemblies as column 2 OR path to a contig file (used if only doing a single sample - should provide value for -pfx). Assemblies may be compressed with gzip, bzip2, xz or zstd.",
     )
     parser_sub_run.add_argument(
         "--prefix",
@@ -68,6 +106,62 @@ def main():
         # default="/home/khhor/conda/envs/abritamr/share/amrfinderplus/data/2021-09-30.1/",
         help="Path to amrfinder DB to use"
     )
+    parser_sub_run.add_argument(
+        "--engine",
+        default="native",
+        choices=["native", "parallel"],
+        help="How to schedule amrfinder jobs - native runs each sample in a bounded pool of workers, parallel uses GNU parallel."
+    )
+    parser_sub_run.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip samples that completed in a previous run with the same inputs and settings (native engine only)."
+    )
+    parser_sub_run.add_argument(
+        "--cache",
+        default="",
+        help="Directory for a cache of amrfinder results shared between runs. Assemblies already in the cache (with the same DB, species, identity and amrfinder version) will not be run again."
+    )
+    parser_sub_run.add_argument(
+        "--cache_size",
+        default=10,
+        help="Maximum size of the amrfinder result cache in GB. The least recently used results are removed first."
+    )
+    parser_sub_run.add_argument(
+        "--shard",
+        default="",
+        help="Run only part of a batch, given as i/N (eg 1/4). Samples are split between N shards by assembly size and the outputs of shard i are saved in shard_i_of_N. Combine the shards with abritamr merge."
+    )
+    parser_sub_run.add_argument(
+        "--chunks",
+        default=1,
+        help="Split a single assembly into this many groups of contigs and run amrfinder on them at the same time, sharing --jobs threads between them (native engine only). Can reduce the time taken for a single large assembly."
+    )
+    parser_sub_run.add_argument(
+        "--pack_size",
+        default=0,
+        help="In batch mode, run small assemblies together in packs of up to this many Mb with a single amrfinder, saving its start up cost for each sample (native engine only). 0 runs every sample on its own."
+    )
+    parser_sub_run.add_argument(
+        "--stage_db",
+        default="",
+        help="Node local directory (eg /dev/shm or local scratch) to copy the amrfinder DB to for the run. The copy is shared by runs on the same node and removed when the last one finishes."
+    )
+    parser_sub_run.add_argument(
+        "--tmpdir",
+        default="",
+        help="Node local directory for amrfinder scratch space. Each job gets its own directory in it (as TMPDIR), removed when the job finishes. Defaults to TMPDIR or /tmp."
+    )
+    parser_sub_run.add_argument(
+        "--retries",
+        default=1,
+        help="Number of times to try a sample again, waiting a little longer each time, if amrfinder fails for it. Samples that still fail are listed in abritamr_failures.tsv and left out of the summaries, the rest of the batch is collated as usual."
+    )
+    parser_sub_run.add_argument(
+        "--server",
+        default="",
+        help="Socket of a running abritamr serve - the sample is submitted to it and the collated result printed as json, instead of running here. Single samples only."
+    )
     parser_sub_run.add_argument(
         "--species",
         "-sp",
@@ -76,6 +170,58 @@ def main():
         choices= ["Burkholderia_cepacia","Acinetobacter_baumannii","Streptococcus_pyogenes","Streptococcus_agalactiae","Streptococcus_pneumoniae","Enterococcus_faecium","Pseudomonas_aeruginosa","Staphylococcus_pseudintermedius","Clostridioides_difficile","Klebsiella","Neisseria","Campylobacter","Salmonella","Escherichia","Staphylococcus_aureus","Burkholderia_pseudomallei","Enterococcus_faecalis"]
     )
     
+    parser_serve = subparsers.add_parser('serve', help='Keep abritamr running and accept single samples over a unix socket', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_serve.add_argument(
+        "--socket",
+        default="abritamr.sock",
+        help="Path of the unix socket to listen on."
+    )
+    parser_serve.add_argument(
+        "--workers",
+        default=2,
+        help="Number of samples to run at a time."
+    )
+    parser_serve.add_argument(
+        "--jobs",
+        "-j",
+        default=8,
+        help="Number of threads for each amrfinder job."
+    )
+    parser_serve.add_argument(
+        "--chunks",
+        default=1,
+        help="Split each assembly into this many groups of contigs and run amrfinder on them at the same time, sharing --jobs threads between them."
+    )
+    parser_serve.add_argument(
+        "--amrfinder_db", 
+        "-d", 
+        default=f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus' / 'data' / f'{db}/'}", 
+        help="Path to amrfinder DB to use"
+    )
+    parser_serve.add_argument(
+        "--cache",
+        default="",
+        help="Directory for a cache of amrfinder results shared between runs."
+    )
+    parser_serve.add_argument(
+        "--cache_size",
+        default=10,
+        help="Maximum size of the amrfinder result cache in GB."
+    )
+
+    parser_merge = subparsers.add_parser('merge', help='Merge the summaries of a sharded batch', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_merge.add_argument(
+        "shards",
+        nargs="*",
+        help="Shard output directories to merge, in order. Defaults to all shard_i_of_N directories in the current directory."
+    )
+    parser_merge.add_argument(
+        "--outdir",
+        "-o",
+        default="",
+        help="Directory to save the merged summaries in. Defaults to the current directory."
+    )
+
     parser_mdu = subparsers.add_parser('report', help='Generate report for use at MDU', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     
     parser_mdu.add_argument(
@@ -113,11 +259,19 @@ def main():
         default=f"",
         help="The name of the process - will be reflected in the names od the output files."
     )
+    parser_mdu.add_argument(
+        "--format",
+        default=f"xlsx",
+        choices = ['xlsx', 'csv', 'parquet'],
+        help="Format of the report - a single spreadsheet, or a csv or parquet file for each sheet (parquet needs pyarrow). Rows are written as they are made so large runs can be reported in little memory."
+    )
 
     
     
     parser_sub_run.set_defaults(func=run_pipeline)
     parser_mdu.set_defaults(func = mdu)
+    parser_merge.set_defaults(func = merge)
+    parser_serve.set_defaults(func = serve)
     args = parser.parse_args()
     
     if len(sys.argv) < 2:
@@ -127,6 +281,9 @@ def main():
     elif len(sys.argv) <= 2 and sys.argv[1] == 'report':
         parser_mdu.print_help(sys.stderr)
     else:
+        if args.debug:
+            from abritamr.CustomLog import setup_logging
+            setup_logging(debug = True)
         args.func(args)
 	
 if __name__ == '__main__':
@@ -1,10 +1,21 @@
-import sys, pathlib, pandas, pytest, numpy, logging, collections
+import sys, pathlib, pandas, pytest, numpy, logging, logging.handlers, collections, time, shutil, socket, gzip, tempfile, subprocess, os
 
 from unittest.mock import patch, PropertyMock
+from concurrent.futures import ThreadPoolExecutor
 
-from abritamr.AmrSetup import Setup, SetupAMR, SetupMDU
+from abritamr.AmrSetup import Setup, SetupAMR, SetupMDU, fasta_stats, FastaStats
 from abritamr.RunFinder import RunFinder
-from abritamr.Collate import Collate, MduCollate
+from abritamr.Collate import Collate, MduCollate, MergeShards
+from abritamr.RefGenes import RefGenesIndex, load_refgenes
+from abritamr import RefGenes
+from abritamr.Cache import ResultCache, probe
+from abritamr.Compression import compression, decompressed
+from abritamr import Compression
+from abritamr.Serve import Service
+from abritamr.Partition import split_fasta, merge_outputs, pack_fasta
+from abritamr.Stage import StagedDB
+from abritamr.Report import ReportWriter
+from abritamr.CustomLog import get_logger
 
 
 
@@ -12,6 +23,14 @@ test_folder = pathlib.Path(__file__).parent
 REFGENES = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'refgenes_latest.csv'}"
 CONTROLS = pathlib.Path(__file__).parent.parent /'abritamr' / 'control'
 
+@pytest.fixture(autouse = True)
+def isolated_cache(tmp_path, monkeypatch):
+    """
+    keep the compiled refgenes and other on-disk caches in the test's tmp_path rather than ~/.cache/abritamr
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", f"{tmp_path / 'cache'}")
+    monkeypatch.setattr(RefGenes, "_LOADED", {})
+
 def test_file_present():
     """
     assert true when the input file is true
@@ -89,9 +108,20 @@ def test_setup_contigs():
         amr_obj.species = ''
         amr_obj.identity = ''
         amr_obj.amrfinder_db = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus'/ 'data'/ '2022-08-09.1'}"
+        amr_obj.engine = 'native'
+        amr_obj.resume = False
+        amr_obj.cache = ''
+        amr_obj.cache_size = 10
+        amr_obj.shard = ''
+        amr_obj.chunks = 1
+        amr_obj.pack_size = 0
+        amr_obj.stage_db = ''
+        amr_obj.tmpdir = ''
+        amr_obj.retries = 0
         amr_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db'])
-        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db', 'engine', 'resume', 'cache', 'cache_size', 'sizes', 'outdir', 'chunks', 'pack_size', 'stage_db', 'tmpdir', 'retries'])
+        sizes = {'somename': fasta_stats(CONTROLS / 'contigs.fa')}
+        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db, amr_obj.engine, amr_obj.resume, amr_obj.cache, amr_obj.cache_size, sizes, '', amr_obj.chunks, amr_obj.pack_size, amr_obj.stage_db, amr_obj.tmpdir, amr_obj.retries)
         assert amr_obj.setup() == input_data
 
 def test_species():
@@ -103,9 +133,20 @@ def test_species():
         amr_obj.species = 'Neiserria'
         amr_obj.identity = ''
         amr_obj.amrfinder_db = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus'/ 'data'/ '2022-08-09.1'}"
+        amr_obj.engine = 'native'
+        amr_obj.resume = False
+        amr_obj.cache = ''
+        amr_obj.cache_size = 10
+        amr_obj.shard = ''
+        amr_obj.chunks = 1
+        amr_obj.pack_size = 0
+        amr_obj.stage_db = ''
+        amr_obj.tmpdir = ''
+        amr_obj.retries = 0
         amr_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db'])
-        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism', 'identity','amrfinder_db', 'engine', 'resume', 'cache', 'cache_size', 'sizes', 'outdir', 'chunks', 'pack_size', 'stage_db', 'tmpdir', 'retries'])
+        sizes = {'somename': fasta_stats(CONTROLS / 'contigs.fa')}
+        input_data = T('assembly', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity, amr_obj.amrfinder_db, amr_obj.engine, amr_obj.resume, amr_obj.cache, amr_obj.cache_size, sizes, '', amr_obj.chunks, amr_obj.pack_size, amr_obj.stage_db, amr_obj.tmpdir, amr_obj.retries)
         assert amr_obj.setup() == input_data
 
 
@@ -118,11 +159,159 @@ def test_setup_batch():
         amr_obj.species = ''
         amr_obj.identity = ''
         amr_obj.amrfinder_db = f"{pathlib.Path(__file__).parent.parent /'abritamr' /'db' / 'amrfinderplus'/ 'data'/ '2022-08-09.1'}"
+        amr_obj.engine = 'native'
+        amr_obj.resume = False
+        amr_obj.cache = ''
+        amr_obj.cache_size = 10
+        amr_obj.shard = ''
+        amr_obj.chunks = 1
+        amr_obj.pack_size = 0
+        amr_obj.stage_db = ''
+        amr_obj.tmpdir = ''
+        amr_obj.retries = 0
         amr_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism','identity', 'amrfinder_db'])
-        input_data = T('batch', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity,amr_obj.amrfinder_db)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'organism','identity', 'amrfinder_db', 'engine', 'resume', 'cache', 'cache_size', 'sizes', 'outdir', 'chunks', 'pack_size', 'stage_db', 'tmpdir', 'retries'])
+        sizes = {'tests': fasta_stats(test_folder / 'summary_partials.txt')}
+        input_data = T('batch', amr_obj.contigs, amr_obj.prefix, amr_obj.jobs, amr_obj.species, amr_obj.identity,amr_obj.amrfinder_db, amr_obj.engine, amr_obj.resume, amr_obj.cache, amr_obj.cache_size, sizes, '', amr_obj.chunks, amr_obj.pack_size, amr_obj.stage_db, amr_obj.tmpdir, amr_obj.retries)
         assert amr_obj.setup() == input_data
  
+def test_fasta_stats(tmp_path):
+    """
+    assert the length and number of contigs are counted
+    """
+    fa = tmp_path / 'contigs.fa'
+    fa.write_text(">c1 some description\nACGT\nAC\n>c2\nACGTACGTAC\n")
+    assert fasta_stats(fa) == FastaStats(16, 2)
+
+def test_input_files_missing_assembly(tmp_path):
+    """
+    assert a batch with a missing assembly is rejected and sizes are recorded for a good batch
+    """
+    fa = tmp_path / 'a.fa'
+    fa.write_text(">c1\nACGT\n")
+    batch = tmp_path / 'batch.tsv'
+    batch.write_text(f"a\t{fa}\nb\t{tmp_path / 'b.fa'}\n")
+    with patch.object(SetupAMR, "__init__", lambda x: None):
+        amr_obj = SetupAMR()
+        amr_obj.contigs = f"{batch}"
+        amr_obj.prefix = ''
+        amr_obj.logger = logging.getLogger(__name__)
+        with pytest.raises(SystemExit):
+            amr_obj._input_files()
+        batch.write_text(f"a\t{fa}\n\n")
+        assert amr_obj._input_files() == 'batch'
+        assert amr_obj.sizes == {'a': FastaStats(4, 1)}
+
+def test_compressed_contigs(tmp_path):
+    """
+    assert compressed assemblies are detected by their magic bytes, sized and decompressed to a temporary file that is removed afterwards
+    """
+    import gzip, bz2, lzma
+    text = b">c1\nACGT\n>c2\nAC\n"
+    for ext, mod in [('gz', gzip), ('bz2', bz2), ('xz', lzma)]:
+        fa = tmp_path / f"contigs.{ext}"
+        fa.write_bytes(mod.compress(text))
+        assert compression(fa) == ext
+        assert fasta_stats(fa) == FastaStats(6, 2)
+        with decompressed(fa, tmpdir = tmp_path) as path:
+            assert pathlib.Path(path).read_bytes() == text
+        assert not pathlib.Path(path).exists()
+    assert compression(CONTROLS / 'contigs.fa') == ''
+    with decompressed(CONTROLS / 'contigs.fa') as path:
+        assert path == f"{CONTROLS / 'contigs.fa'}"
+
+def test_check_assembly_corrupt(tmp_path):
+    """
+    assert a truncated compressed assembly stops setup with a message rather than a traceback
+    """
+    import bz2, lzma
+    text = b">c1\nACGT\n>c2\nAC\n" * 1000
+    with patch.object(SetupAMR, "__init__", lambda x: None):
+        amr_obj = SetupAMR()
+        amr_obj.logger = logging.getLogger(__name__)
+        for ext, mod in [('gz', gzip), ('bz2', bz2), ('xz', lzma)]:
+            fa = tmp_path / f"contigs.{ext}"
+            data = mod.compress(text)
+            fa.write_bytes(data[:len(data) // 2])
+            with pytest.raises(SystemExit):
+                amr_obj._check_assembly(f"{fa}")
+            fa.write_bytes(data)
+            assert amr_obj._check_assembly(f"{fa}") == FastaStats(6000, 2000)
+
+def test_zstd_cli(tmp_path, monkeypatch):
+    """
+    assert the zstd command line fallback reads a .zst assembly, and reports a corrupt file or a missing zstd rather than giving truncated contigs
+    """
+    zstd = shutil.which('zstd')
+    if zstd is None:
+        pytest.skip("zstd is not installed")
+    monkeypatch.setattr(Compression, "zstandard", None)
+    text = b">c1\nACGT\n>c2\nAC\n" * 1000
+    fa = tmp_path / 'contigs.fa'
+    fa.write_bytes(text)
+    subprocess.run([zstd, '-q', f"{fa}", '-o', f"{tmp_path / 'contigs.zst'}"], check = True)
+    data = (tmp_path / 'contigs.zst').read_bytes()
+    with Compression.open_contigs(tmp_path / 'contigs.zst') as f:
+        assert f.read() == text
+    (tmp_path / 'contigs.zst').write_bytes(data[:len(data) // 2])
+    with pytest.raises(Compression.CompressionError):
+        fasta_stats(tmp_path / 'contigs.zst')
+    monkeypatch.setenv("PATH", f"{tmp_path / 'empty'}")
+    with pytest.raises(Compression.CompressionError, match = "zstd is needed"):
+        fasta_stats(tmp_path / 'contigs.zst')
+
+def test_assign_shards():
+    """
+    assert shards are balanced on assembly size and every sample is in exactly one shard
+    """
+    with patch.object(SetupAMR, "__init__", lambda x: None):
+        amr_obj = SetupAMR()
+        rows = [[f"s{i}", f"s{i}.fa"] for i in range(6)]
+        sizes = {f"s{i}": b for i, b in enumerate([100, 10, 60, 40, 50, 30])}
+        shards, load = amr_obj._assign_shards(rows, 2, sizes)
+        assert shards == [0, 0, 1, 0, 1, 1]
+        assert load == [150, 140]
+        amr_obj.shard = '3/2'
+        amr_obj.logger = logging.getLogger(__name__)
+        with pytest.raises(SystemExit):
+            amr_obj._parse_shard()
+
+def test_shard_reads_own_assemblies(tmp_path, monkeypatch):
+    """
+    assert a shard is split on the sizes of the assemblies on disk and only reads its own assemblies
+    """
+    monkeypatch.chdir(tmp_path)
+    for i, b in enumerate([100, 10, 60, 40]):
+        (tmp_path / f"s{i}.fa").write_text(f">s{i}\n{'A' * b}\n")
+    (tmp_path / 'batch.tsv').write_text(''.join(f"s{i}\t{tmp_path / f's{i}.fa'}\n" for i in range(4)))
+    with patch.object(SetupAMR, "__init__", lambda x: None):
+        amr_obj = SetupAMR()
+        amr_obj.logger = logging.getLogger(__name__)
+        amr_obj.contigs = f"{tmp_path / 'batch.tsv'}"
+        amr_obj.engine = 'native'
+        amr_obj.shard = '1/2'
+        with patch("abritamr.AmrSetup.fasta_stats", side_effect = fasta_stats) as stats:
+            assert amr_obj._input_files() == 'batch'
+        assert sorted(pathlib.Path(c.args[0]).name for c in stats.call_args_list) == ['s0.fa', 's1.fa']
+        assert sorted(amr_obj.sizes) == ['s0', 's1']
+        assert amr_obj.outdir == 'shard_1_of_2'
+        assert (tmp_path / amr_obj.contigs).read_text().split('\n')[0].split('\t')[0] == 's0'
+
+def test_merge_shards(tmp_path):
+    """
+    assert shard summaries are merged with the union of their columns and the combined file stays sorted
+    """
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'a' / 'abritamr.txt').write_text("Isolate\tESBL\nS1\tblaCTX-M-15\nS3\tblaSHV-12\n")
+    (tmp_path / 'b' / 'abritamr.txt').write_text("Isolate\tAminoglycoside\tESBL\nS2\taac(6')-Ib\t\n")
+    with patch.object(MergeShards, "__init__", lambda x: None):
+        amr_obj = MergeShards()
+        amr_obj.logger = logging.getLogger(__name__)
+        out = tmp_path / 'abritamr.txt'
+        amr_obj.merge_table([tmp_path / 'a' / 'abritamr.txt', tmp_path / 'b' / 'abritamr.txt'], out, sort = True)
+        assert out.read_text() == "Isolate\tESBL\tAminoglycoside\nS1\tblaCTX-M-15\t\nS2\t\taac(6')-Ib\nS3\tblaSHV-12\t\n"
+
 def test_setup_fail():
     with patch.object(SetupAMR, "__init__", lambda x: None):
         amr_obj = SetupAMR()
@@ -138,14 +327,14 @@ def test_setup_fail():
             amr_obj.setup()
 
 # # Test SetupMDU
-MDU = collections.namedtuple('MDU', ['runid', 'matches', 'partials', 'qc', 'sop', 'sop_name'])
+MDU = collections.namedtuple('MDU', ['runid', 'matches', 'partials', 'qc', 'sop', 'sop_name', 'format'])
 
 def test_prefix_string():
     """
     assert True when non-empty string is given
     """
     with patch.object(SetupAMR, "__init__", lambda x: None):
-        args = MDU("RUNID", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name')
+        args = MDU("RUNID", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name', 'xlsx')
         amr_obj = SetupMDU(args)
         # amr_obj.runid= 
         amr_obj.logger = logging.getLogger(__name__)
@@ -156,7 +345,7 @@ def test_prefix_empty():
     assert True when non-empty string is given
     """
     with patch.object(SetupAMR, "__init__", lambda x: None):
-        args = MDU("", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name')
+        args = MDU("", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name', 'xlsx')
         amr_obj = SetupMDU(args)
         amr_obj.logger = logging.getLogger(__name__)
         with pytest.raises(SystemExit):
@@ -168,10 +357,10 @@ def test_mdu_setup_success():
     assert True when non-empty string is given
     """
     with patch.object(SetupAMR, "__init__", lambda x: None):
-        args = MDU("RUNID", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name')
+        args = MDU("RUNID", 'tests/summary_matches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name', 'xlsx')
         amr_obj = SetupMDU(args)
-        Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid','sop', 'sop_name'])
-        d = Data(args.qc, args.matches, args.partials, amr_obj.db, args.runid, args.sop, args.sop_name)
+        Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid','sop', 'sop_name', 'format'])
+        d = Data(args.qc, args.matches, args.partials, amr_obj.db, args.runid, args.sop, args.sop_name, args.format)
         amr_obj.logger = logging.getLogger(__name__)
         assert amr_obj.setup() == d
 
@@ -181,7 +370,7 @@ def test_mdu_setup_fail():
     assert True when non-empty string is given
     """
     with patch.object(SetupAMR, "__init__", lambda x: None):
-        args = MDU("RUNID", 'tests/summarymatches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name')
+        args = MDU("RUNID", 'tests/summarymatches.txt', 'tests/summary_matches.txt', 'tests/mdu_qc_checked.csv', 'general', 'sop_name', 'xlsx')
         amr_obj = SetupMDU(args)
         Data = collections.namedtuple('Data', ['qc', 'matches', 'partials', 'db', 'runid'])
         d = Data(args.qc, args.matches, args.partials, amr_obj.db, args.runid)
@@ -189,6 +378,107 @@ def test_mdu_setup_fail():
         with pytest.raises(SystemExit):
             amr_obj.setup()
 
+def test_qc_join(tmp_path):
+    """
+    assert isolates are joined to their own QC row - not one whose ID they are the start of - and the QC is read once
+    """
+    qc = tmp_path / 'qc.csv'
+    qc.write_text("ISOLATE,SPECIES_EXP,SPECIES_OBS,TEST_QC\n2021-12345-10,Escherichia coli,Escherichia coli,PASS\n2021-12345-1,Salmonella enterica,Salmonella enterica,FAIL\n2021-54321,Shigella sonnei,Shigella sonnei,PASS\n")
+    with patch.object(MduCollate, "__init__", lambda x: None):
+        mdu_obj = MduCollate()
+        mdu_obj.logger = logging.getLogger(__name__)
+        mdu_obj.mduqc = f"{qc}"
+        with patch.object(MduCollate, "mdu_qc_tab", side_effect = MduCollate.mdu_qc_tab, autospec = True) as read:
+            joined = mdu_obj.qc_join(['2021-12345-1', '2021-12345-10', 'reads/2021-54321-2'])
+            mdu_obj.qc_join(['2021-12345-1'])
+            assert read.call_count == 1
+        assert list(joined['SPECIES_EXP']) == ['Salmonella enterica', 'Escherichia coli', 'Shigella sonnei']
+        with pytest.raises(SystemExit):
+            mdu_obj.qc_join(['2021-99999'])
+
+def test_mdu_reporting_general(tmp_path):
+    """
+    assert the general rules are applied to all isolates at once - species exceptions, gene patterns and the codes used when nothing is found
+    """
+    qc = tmp_path / 'qc.csv'
+    qc.write_text("ISOLATE,SPECIES_EXP,SPECIES_OBS,TEST_QC\n2021-00001,Stenotrophomonas maltophilia,Stenotrophomonas maltophilia,PASS\n2021-00002,Shigella sonnei,Shigella sonnei,PASS\n2021-00003,Staphylococcus aureus,Staphylococcus aureus,PASS\n2021-00004,Escherichia coli,Escherichia coli,PASS\n")
+    match = tmp_path / 'summary_matches.txt'
+    match.write_text("Isolate\tCarbapenemase (MBL)\tESBL\tVancomycin\tMethicillin\tClindamycin/Linezolid\tCarbapenemase (KPC variant)\tQuinolone\n"
+        "2021-00001\tblaL1,blaNDM-1\t\t\t\t\t\t\n"
+        "2021-00002\t\tblaEC-5,blaCTX-M-15\t\t\t\t\tgyrA_S83L\n"
+        "2021-00003\t\t\tvanA,vanR\tmecA,mecR1\tcfr\t\t\n"
+        "2021-00004\t\tblaCTX-M-15\t\t\tcfr\tblaKPC-2\t\n")
+    with patch.object(MduCollate, "__init__", lambda x: None):
+        mdu_obj = MduCollate()
+        mdu_obj.logger = logging.getLogger(__name__)
+        mdu_obj.mduqc = f"{qc}"
+        mdu_obj.db = '2022-08-09.1'
+        mdu_obj.NONE_CODES = {"Shigella":"CPase_ESBL_AmpC_16S_NEG"}
+        report = mdu_obj.mdu_reporting_general(f"{match}")
+        assert list(report["Resistance genes (alleles) detected"]) == ['NDM-1', 'CTX-M-15', 'vanA,mecA,cfr', 'CPase_16S_mcr_NEG']
+        assert list(report["Resistance genes (alleles) det (non-rpt)"]) == ['blaL1', 'EC-5', 'vanR,mecR1', 'CTX-M-15,cfr,KPC-2']
+        partials = mdu_obj.mdu_reporting_general(f"{match}", neg_code = False)
+        assert partials.loc['2021-00004', "Resistance genes (alleles) detected"] == ''
+
+def test_mdu_reporting_salmonella(tmp_path):
+    """
+    assert the Salmonella interpretation is made for all isolates at once - genes count towards every antibiotic their class is mapped to and the rest are Other
+    """
+    match = tmp_path / 'summary_matches.txt'
+    match.write_text("Isolate\tAminoglycosides (Ribosomal methyltransferase)\tFosfomycin\tQuinolone\tSulfonamide\tTrimethoprim\n"
+        "2021-00001\tarmA\tfosA,armA\tqnrS1\tsul1\tdfrA1\n"
+        "2021-00002\t\t\tqnrS1,gyrA_S83F\t\t\n"
+        "2021-00003\t\t\t\t\t\n")
+    with patch.object(MduCollate, "__init__", lambda x: None):
+        mdu_obj = MduCollate()
+        mdu_obj.logger = logging.getLogger(__name__)
+        report = mdu_obj.mdu_reporting_salmonella(f"{match}", ['2021-00001', '2021-00002'])
+        assert list(report["MDU Sample ID"]) == ['2021-00001', '2021-00002']
+        assert list(report["Gentamicin - ResMech"]) == ['armA', 'None detected']
+        assert list(report["Aminoglycosides (RMT) - ResMech"]) == ['armA', 'None detected']
+        assert list(report["Other - ResMech"]) == ['fosA', 'None detected']
+        assert list(report["Ciprofloxacin - Interpretation"]) == ['Intermediate', 'Resistant']
+        assert sorted(report["Trim-Sulpha - ResMech"][0].split(';')) == ['dfrA1', 'sul1']
+        assert list(report["Trim-Sulpha - Interpretation"]) == ['Resistant', 'Susceptible']
+
+def test_logger_configured_once():
+    """
+    assert that loggers share a single queue handler however many are made, logging at INFO unless debug is asked for
+    """
+    for i in range(3):
+        logger = get_logger('abritamr.Collate')
+    handlers = logging.getLogger('abritamr').handlers
+    assert len(handlers) == 1 and isinstance(handlers[0], logging.handlers.QueueHandler)
+    assert logger.handlers == [] and not logger.isEnabledFor(logging.DEBUG)
+    from abritamr import CustomLog
+    assert [h.level for h in CustomLog._listener.handlers] == [logging.INFO, logging.INFO]
+    try:
+        CustomLog.setup_logging(debug = True)
+        assert logger.isEnabledFor(logging.DEBUG)
+        assert [h.level for h in CustomLog._listener.handlers] == [logging.INFO, logging.DEBUG]
+    finally:
+        logging.getLogger('abritamr').setLevel(logging.INFO)
+        CustomLog._listener.handlers[1].setLevel(logging.INFO)
+
+def test_report_writer(tmp_path):
+    """
+    assert reports are written a row at a time with the spreadsheet layout, as xlsx or as csv and parquet files for each sheet
+    """
+    df = pandas.DataFrame({'Item code': ['1', ''], 'Species_obs': ['Salmonella enterica', numpy.nan]}, index = pandas.Index(['2021-00001', '2021-00002'], name = 'MDU sample ID'))
+    with ReportWriter(f"{tmp_path / 'RUN_general'}", 'xlsx') as writer:
+        writer.write_frame('general', df)
+        writer.write_frame('Passed QC partial', df.iloc[:0])
+    assert (tmp_path / 'RUN_general.xlsx').exists()
+    with ReportWriter(f"{tmp_path / 'RUN_general'}", 'csv') as writer:
+        writer.write_frame('Passed QC partial', df)
+        writer.write_frame('plus-01', df, index = False)
+    assert (tmp_path / 'RUN_general_Passed_QC_partial.csv').read_text().splitlines() == ['MDU sample ID,Item code,Species_obs', '2021-00001,1,Salmonella enterica', '2021-00002,,']
+    assert (tmp_path / 'RUN_general_plus-01.csv').read_text().splitlines()[0] == 'Item code,Species_obs'
+    pytest.importorskip('pyarrow')
+    with ReportWriter(f"{tmp_path / 'RUN_general'}", 'parquet') as writer:
+        writer.write_frame('general', df)
+    assert pandas.read_parquet(tmp_path / 'RUN_general_general.parquet')['MDU sample ID'].tolist() == ['2021-00001', '2021-00002']
+
 # # test RunFinder
 
 Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'organism'])
@@ -391,6 +681,383 @@ def test_check_outputs_batch():
         amr_obj.logger = logging.getLogger(__name__)
         assert amr_obj._check_outputs()
 
+def fake_amrfinder(tmp_path):
+    """
+    write a stand in for amrfinder that copies the test output to -o and fails for inputs named bad
+    """
+    script = tmp_path / 'amrfinder'
+    script.write_text(f"""#!/bin/sh
+while [ $# -gt 0 ]; do case $1 in -o) out=$2; shift;; -n) in=$2; shift;; esac; shift; done
+case $in in *bad*) echo "bad input" >&2; exit 1;; esac
+cp {test_folder / 'amrfinder.out'} $out
+""")
+    script.chmod(0o755)
+    return f"{script}"
+
+def native_finder(tmp_path, samples):
+    """
+    a RunFinder for a batch of samples using the native engine and a fake amrfinder
+    """
+    batch = tmp_path / 'batch.tsv'
+    batch.write_text(''.join(f"{tmp_path / s}\t{tmp_path / s}.fa\n" for s in samples))
+    amr_obj = RunFinder()
+    amr_obj.AMRFINDER = fake_amrfinder(tmp_path)
+    amr_obj.organism = ''
+    amr_obj.run_type = 'batch'
+    amr_obj.prefix = ''
+    amr_obj.jobs = 2
+    amr_obj.input = f"{batch}"
+    amr_obj.amrfinder_db = ''
+    amr_obj.identity = ''
+    amr_obj.db = '2022-08-09.1'
+    amr_obj.engine = 'native'
+    amr_obj.resume = False
+    amr_obj.cache = ''
+    amr_obj.cache_size = 10
+    amr_obj.sizes = {}
+    amr_obj.chunks = 1
+    amr_obj.pack_size = 0
+    amr_obj.tmpdir = f"{tmp_path / 'scratch'}"
+    amr_obj.retries = 0
+    amr_obj.RETRY_BACKOFF = 0
+    amr_obj.PLAN = f"{tmp_path / 'abritamr_plan.tsv'}"
+    amr_obj.JOURNAL = f"{tmp_path / 'abritamr_journal.jsonl'}"
+    amr_obj.METRICS = f"{tmp_path / 'abritamr_metrics.tsv'}"
+    amr_obj.FAILURES = f"{tmp_path / 'abritamr_failures.tsv'}"
+    amr_obj.logger = logging.getLogger(__name__)
+    return amr_obj
+
+def test_sample_cmd():
+    """
+    assert the native command has the same arguments as the parallel command
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = RunFinder()
+        amr_obj.organism = 'Salmonella'
+        amr_obj.amrfinder_db = "2021-06-01.1"
+        amr_obj.identity = '0.9'
+        assert amr_obj._sample_cmd('sample1', 'sample1.fa') == ['amrfinder', '-n', 'sample1.fa', '-o', 'sample1/amrfinder.out', '--plus', '--organism', 'Salmonella', '--threads', '1', '-d', '2021-06-01.1', '--ident_min', '0.9']
+
+def test_run_native(tmp_path):
+    """
+    assert each sample is run and handed on as it finishes, with failures reported per sample
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 's2', 'bad'])
+        finished = []
+        assert not amr_obj._run_native(on_complete = finished.append)
+        assert sorted(pathlib.Path(j.prefix).name for j in finished) == ['bad', 's1', 's2']
+        assert (tmp_path / 's1' / 'amrfinder.out').exists()
+        assert amr_obj.results[f"{tmp_path / 'bad'}"].returncode == 1
+        assert amr_obj.results[f"{tmp_path / 'bad'}"].stderr == 'bad input\n'
+
+def test_run_metrics(tmp_path):
+    """
+    assert resource usage is recorded for each sample
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 'bad'])
+        amr_obj._run_native()
+        metrics = pandas.read_csv(tmp_path / 'abritamr_metrics.tsv', sep = '\t', index_col = 'sample')
+        assert list(metrics.columns) == RunFinder.METRICS_COLS[1:]
+        s1 = metrics.loc[f"{tmp_path / 's1'}"]
+        assert s1['status'] == 'completed'
+        assert s1['hits'] == 4
+        assert s1['max_rss_kb'] > 0
+        assert metrics.loc[f"{tmp_path / 'bad'}"]['status'] == 'failed'
+
+def test_service_run_sample(tmp_path):
+    """
+    assert a warm service runs a submitted sample and returns the collated rows
+    """
+    args = collections.namedtuple('Args', ['socket', 'workers', 'jobs', 'chunks', 'amrfinder_db', 'cache', 'cache_size'])
+    service = Service(args(f"{tmp_path / 'abritamr.sock'}", 1, 1, 1, 'db/2022-08-09.1', '', 10))
+    service.warm()
+    service.runner.AMRFINDER = fake_amrfinder(tmp_path)
+    result = service.submit({'contigs': f"{CONTROLS / 'contigs.fa'}", 'prefix': f"{tmp_path / 'sample'}"}).result()
+    assert result['status'] == 'ok'
+    assert result['matches'] == Collate.collate(service.collator, 'tests')[0].assign(Isolate = f"{tmp_path / 'sample'}").to_dict(orient = 'records')[0]
+    assert (tmp_path / 'sample' / 'abritamr.txt').exists()
+    assert service.run_sample({'contigs': 'contigs.fa', 'prefix': f"{tmp_path / 'other'}"})['status'] == 'error'
+    service.pool.shutdown()
+
+def test_service_socket(tmp_path):
+    """
+    assert a service will not take over the socket of a live server, replaces a stale one and creates its socket owner only
+    """
+    args = collections.namedtuple('Args', ['socket', 'workers', 'jobs', 'chunks', 'amrfinder_db', 'cache', 'cache_size'])
+    path = tmp_path / 'abritamr.sock'
+    service = Service(args(f"{path}", 1, 1, 1, 'db/2022-08-09.1', '', 10))
+    service.pool = ThreadPoolExecutor(max_workers = 1)
+    modes = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as live:
+        live.bind(f"{path}")
+        live.listen()
+        with patch.object(Service, "warm") as warm, pytest.raises(SystemExit):
+            service.run()
+        assert not warm.called
+    assert path.exists()
+    with patch.object(Service, "warm"), patch("abritamr.Serve._Server.serve_forever", lambda server: modes.append(path.stat().st_mode & 0o777)):
+        service.run()
+    assert modes == [0o600]
+    assert not path.exists()
+
+def test_split_fasta(tmp_path):
+    """
+    assert contigs are split whole into balanced chunks, keeping their order
+    """
+    fa = tmp_path / 'contigs.fa'
+    fa.write_text(">c1\nAAAAAAAAAA\n>c2\nAAAA\n>c3\nAAAAAA\nAA\n>c4\nA\n")
+    chunks = split_fasta(fa, 2, tmp_path)
+    assert [pathlib.Path(c).read_text() for c in chunks] == [">c1\nAAAAAAAAAA\n>c4\nA\n", ">c2\nAAAA\n>c3\nAAAAAA\nAA\n"]
+
+def test_run_chunked(tmp_path):
+    """
+    assert a chunked single sample gives one amrfinder.out with each hit once, sorted on contig and position
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1'])
+        amr_obj.run_type = 'assembly'
+        amr_obj.prefix = f"{tmp_path / 's1'}"
+        amr_obj.input = f"{tmp_path / 's1.fa'}"
+        amr_obj.chunks = 3
+        amr_obj.PLAN, amr_obj.JOURNAL, amr_obj.METRICS = RunFinder.PLAN, RunFinder.JOURNAL, RunFinder.METRICS
+        (tmp_path / 's1.fa').write_text(">c1\nACGT\n>c2\nACGT\n>c3\nAC\n")
+        assert amr_obj._run_native()
+        header, *rows = (test_folder / 'amrfinder.out').read_text().strip().split('\n')
+        merged = (tmp_path / 's1' / 'amrfinder.out').read_text().strip().split('\n')
+        assert merged[0] == header
+        assert sorted(merged[1:]) == sorted(set(rows))
+        assert [p.name for p in (tmp_path / 's1').iterdir() if p.name.startswith('chunks.')] == []
+        # a compressed assembly is decompressed in the scratch directory and removed afterwards
+        with gzip.open(tmp_path / 's1.fa.gz', 'wt') as f:
+            f.write(">c1\nACGT\n>c2\nACGT\n>c3\nAC\n")
+        amr_obj.input = f"{tmp_path / 's1.fa.gz'}"
+        with patch("abritamr.RunFinder.decompressed", side_effect = decompressed) as decomp:
+            assert amr_obj._run_native()
+        assert all(pathlib.Path(c.kwargs['tmpdir']).parent == tmp_path / 'scratch' for c in decomp.call_args_list)
+        assert list((tmp_path / 'scratch').iterdir()) == []
+
+def test_run_packed(tmp_path):
+    """
+    assert samples run in packs give the same amrfinder.out as samples run on their own, including a sample whose fasta has no final newline
+    """
+    script = tmp_path / 'amrfinder_contigs'
+    script.write_text(f"""#!/bin/sh
+while [ $# -gt 0 ]; do case $1 in -o) out=$2; shift;; -n) in=$2; shift;; esac; shift; done
+head -1 {test_folder / 'amrfinder.out'} > $out
+for c in $(grep '>' $in | cut -c2- | cut -d' ' -f1 | sort); do sed -n 2p {test_folder / 'amrfinder.out'} | awk -v c=$c 'BEGIN {{FS = OFS = "\\t"}} {{$2 = c; print}}' >> $out; done
+""")
+    script.chmod(0o755)
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 's2', 's3'])
+        amr_obj.AMRFINDER = f"{script}"
+        for s, contigs in [('s1', 'c2 x\n>c1'), ('s2', 'a'), ('s3', 'c9')]:
+            (tmp_path / f"{s}.fa").write_text(f">{contigs}\nACGT" + ("" if s == 's2' else "\n"))
+        amr_obj.sizes = {f"{tmp_path / s}": FastaStats(4, 1) for s in ['s1', 's2', 's3']}
+        amr_obj._run_native()
+        alone = {s: (tmp_path / s / 'amrfinder.out').read_text() for s in ['s1', 's2', 's3']}
+        amr_obj.pack_size = 1
+        assert amr_obj._packs(amr_obj._samples()) == [amr_obj._samples()]
+        for s in ['s1', 's2', 's3']:
+            (tmp_path / s / 'amrfinder.out').unlink()
+        assert amr_obj._run_native()
+        assert {s: (tmp_path / s / 'amrfinder.out').read_text() for s in ['s1', 's2', 's3']} == alone
+        assert alone['s1'].split('\n')[1].split('\t')[1] == 'c1'
+        assert alone['s3'].split('\n')[1].split('\t')[1] == 'c9'
+        pack_fasta([tmp_path / 's2.fa', tmp_path / 's3.fa'], tmp_path / 'pack.fa')
+        assert (tmp_path / 'pack.fa').read_text() == ">abritamr000000_a\nACGT\n>abritamr000001_c9\nACGT\n"
+
+def test_job_tmpdir(tmp_path, monkeypatch):
+    """
+    assert each job runs with its own TMPDIR under --tmpdir, removed when it finishes, and that a full scratch directory only stops the run when it was chosen with --tmpdir
+    """
+    script = tmp_path / 'amrfinder_tmp'
+    script.write_text(f"""#!/bin/sh
+while [ $# -gt 0 ]; do case $1 in -o) out=$2; shift;; esac; shift; done
+test -d "$TMPDIR" && echo $TMPDIR >> {tmp_path / 'tmpdirs.txt'}
+cp {test_folder / 'amrfinder.out'} $out
+""")
+    script.chmod(0o755)
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 's2'])
+        amr_obj.AMRFINDER = f"{script}"
+        assert amr_obj._run_native()
+        tmpdirs = (tmp_path / 'tmpdirs.txt').read_text().split()
+        assert len(set(tmpdirs)) == 2
+        assert all(pathlib.Path(t).parent == tmp_path / 'scratch' and not pathlib.Path(t).exists() for t in tmpdirs)
+        amr_obj.TMP_MIN_BYTES = shutil.disk_usage(tmp_path).free * 2
+        with pytest.raises(SystemExit):
+            amr_obj._run_native()
+        amr_obj.tmpdir = ''
+        monkeypatch.setattr(tempfile, "tempdir", f"{tmp_path / 'system'}")
+        assert amr_obj._run_native()
+
+def test_pipelined_collate(tmp_path):
+    """
+    assert the default native batch reads each sample's hits as amrfinder finishes and collates them once with the vectorised engine, giving the same summaries as collating afterwards
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None), patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 's2', 's3'])
+        col_obj = Collate()
+        col_obj.logger = logging.getLogger(__name__)
+        col_obj.run_type = 'batch'
+        col_obj.input = amr_obj.input
+        col_obj.prefix = ''
+        col_obj.outdir = f"{tmp_path}"
+        assert amr_obj._run_native(on_complete = col_obj.collect_job)
+        assert len(col_obj.collected) == 3
+        with patch.object(Collate, "_classify_hits", autospec = True, side_effect = Collate._classify_hits) as classify, patch.object(Collate, "_hit_lines", autospec = True, side_effect = Collate._hit_lines) as reread:
+            col_obj.run()
+        assert classify.call_count == 1
+        assert reread.call_count == 0
+        prefixes = [f"{tmp_path / s}" for s in ['s1', 's2', 's3']]
+        serial = col_obj.collate_all(prefixes)
+        for p, s in zip(col_obj.summaries, serial):
+            assert p.fillna('').to_dict(orient = 'records') == s.fillna('').to_dict(orient = 'records')
+
+def test_retry_and_quarantine(tmp_path):
+    """
+    assert failed samples are tried again, those that still fail are listed in the failures report and the rest of the batch is collated
+    """
+    script = tmp_path / 'amrfinder_flaky'
+    script.write_text(f"""#!/bin/sh
+while [ $# -gt 0 ]; do case $1 in -o) out=$2; shift;; -n) in=$2; shift;; esac; shift; done
+case $in in *bad*) echo "bad input" >&2; exit 1;; esac
+test -e $in.tried || {{ touch $in.tried; echo "busy" >&2; exit 1; }}
+cp {test_folder / 'amrfinder.out'} $out
+""")
+    script.chmod(0o755)
+    with patch.object(RunFinder, "__init__", lambda x: None), patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 'bad', 's2'])
+        amr_obj.AMRFINDER = f"{script}"
+        amr_obj.retries = 1
+        amr_obj._run_native()
+        assert amr_obj.results[f"{tmp_path / 's1'}"].returncode == 0
+        assert amr_obj.results[f"{tmp_path / 's1'}"].attempts == 2
+        assert amr_obj._check_outputs()
+        failures = pandas.read_csv(tmp_path / 'abritamr_failures.tsv', sep = '\t')
+        assert list(failures['Isolate']) == [f"{tmp_path / 'bad'}"]
+        assert list(failures['Attempts']) == [2]
+        col_obj = Collate()
+        col_obj.logger = logging.getLogger(__name__)
+        col_obj.run_type = 'batch'
+        col_obj.input = amr_obj.input
+        col_obj.prefix = ''
+        col_obj.outdir = f"{tmp_path}"
+        col_obj.run()
+        matches = pandas.read_csv(tmp_path / 'summary_matches.txt', sep = '\t')
+        assert list(matches['Isolate']) == [f"{tmp_path / 's1'}", f"{tmp_path / 's2'}"]
+        amr_obj.results = {p: j for p, j in amr_obj.results.items() if j.returncode == 0}
+        assert amr_obj._check_outputs()
+        assert not (tmp_path / 'abritamr_failures.tsv').exists()
+
+def test_corrupt_assembly_quarantined(tmp_path):
+    """
+    assert a compressed assembly that can not be read fails on its own, run alone or in a pack, and the rest of the batch completes
+    """
+    data = gzip.compress(b">c1\nACGT\n" * 1000)
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['s1', 'bad', 's2'])
+        for s in ['s1', 's2']:
+            (tmp_path / f"{s}.fa").write_text(f">{s}\nACGT\n")
+        (tmp_path / 'bad.fa').write_bytes(data[:len(data) // 2])
+        for pack_size in [0, 1]:
+            amr_obj.pack_size = pack_size
+            amr_obj.sizes = {f"{tmp_path / s}": FastaStats(4, 1) for s in ['s1', 'bad', 's2']}
+            assert not amr_obj._run_native()
+            assert {pathlib.Path(p).name: j.returncode == 0 for p, j in amr_obj.results.items()} == {'s1': True, 'bad': False, 's2': True}
+            assert amr_obj._check_outputs()
+            failures = pandas.read_csv(tmp_path / 'abritamr_failures.tsv', sep = '\t')
+            assert list(failures['Isolate']) == [f"{tmp_path / 'bad'}"]
+            assert [p.name for p in (tmp_path / 'scratch').iterdir()] == []
+
+def test_plan_largest_first(tmp_path):
+    """
+    assert samples are dispatched longest first
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, ['small', 'large', 'medium'])
+        amr_obj.sizes = {f"{tmp_path / 'small'}": FastaStats(10, 1), f"{tmp_path / 'large'}": FastaStats(1000, 5), f"{tmp_path / 'medium'}": FastaStats(100, 2)}
+        order = amr_obj._plan(amr_obj._samples())
+        assert [pathlib.Path(p).name for p, c in order] == ['large', 'medium', 'small']
+        assert len((tmp_path / 'abritamr_plan.tsv').read_text().strip().split('\n')) == 4
+
+def test_samples_keep_ids(tmp_path):
+    """
+    assert sample ids are read as written, so that they still match the sizes found by setup
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        amr_obj = native_finder(tmp_path, [])
+        (tmp_path / 'batch.tsv').write_text("001\t001.fa\n010\t010.fa\nNA\tNA.fa\n")
+        assert amr_obj._samples() == [('001', '001.fa'), ('010', '010.fa'), ('NA', 'NA.fa')]
+        amr_obj.sizes = {'001': FastaStats(10, 1), '010': FastaStats(1000, 5), 'NA': FastaStats(100, 2)}
+        assert [p for p, c in amr_obj._plan(amr_obj._samples())] == ['010', 'NA', '001']
+
+def test_resume(tmp_path):
+    """
+    assert a resumed run only re-runs samples that are missing, changed or whose output is damaged
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        for s in ['s1', 's2', 's3']:
+            (tmp_path / f"{s}.fa").write_text(f">{s}\nACGT\n")
+        amr_obj = native_finder(tmp_path, ['s1', 's2', 's3'])
+        amr_obj._run_native()
+        amr_obj.resume = True
+        (tmp_path / 's2.fa').write_text(">s2\nACGTACGT\n")
+        (tmp_path / 's3' / 'amrfinder.out').write_text("truncated")
+        amr_obj._run_native()
+        assert {pathlib.Path(p).name: j.skipped for p, j in amr_obj.results.items()} == {'s1': True, 's2': False, 's3': False}
+        # the journal keeps one line per sample however many times the batch is run
+        amr_obj.resume = False
+        amr_obj._run_native()
+        assert len((tmp_path / 'abritamr_journal.jsonl').read_text().splitlines()) == 3
+
+def test_result_cache(tmp_path):
+    """
+    assert a cached result is reused by a new run and that the cache is kept under its size limit
+    """
+    with patch.object(RunFinder, "__init__", lambda x: None):
+        (tmp_path / 's1.fa').write_text(">s1\nACGT\n")
+        amr_obj = native_finder(tmp_path, ['s1'])
+        amr_obj.cache = f"{tmp_path / 'cache'}"
+        amr_obj._run_native()
+        assert not amr_obj.results[f"{tmp_path / 's1'}"].cached
+        (tmp_path / 's1' / 'amrfinder.out').unlink()
+        amr_obj._run_native()
+        assert amr_obj.results[f"{tmp_path / 's1'}"].cached
+        assert (tmp_path / 's1' / 'amrfinder.out').read_text() == (test_folder / 'amrfinder.out').read_text()
+
+def test_result_cache_evicts(tmp_path):
+    """
+    assert the least recently used results are removed first
+    """
+    cache = ResultCache(tmp_path / 'cache', max_bytes = 2500)
+    out = test_folder / 'amrfinder.out'
+    keys = [cache.key(f"{i}", 'db', '', '', '3.10') for i in range(3)]
+    for k in keys:
+        cache.put(k, out)
+        time.sleep(0.01)
+    assert not cache.get(keys[0], tmp_path / 'x.out')
+    assert cache.get(keys[2], tmp_path / 'x.out')
+    assert cache._total() == sum(e[1] for e in cache._entries())
+
+def test_result_cache_scans_when_full(tmp_path):
+    """
+    assert the cache is only scanned for eviction once the running total is over max_bytes
+    """
+    out = test_folder / 'amrfinder.out'
+    size = out.stat().st_size
+    cache = ResultCache(tmp_path / 'cache', max_bytes = size * 3)
+    with patch.object(ResultCache, "_evict", autospec = True, side_effect = ResultCache._evict) as evict:
+        for i in range(4):
+            cache.put(cache.key(f"{i}", 'db', '', '', '3.10'), out)
+            time.sleep(0.01)
+        # storing the same result again does not grow the cache
+        cache.put(cache.key("3", 'db', '', '', '3.10'), out)
+    assert evict.call_count == 1
+    assert cache._total() == size * 3
+
 # # test Collate
 # # 
 Colls = collections.namedtuple('Data', ['run_type', 'input', 'prefix'])
@@ -435,6 +1102,94 @@ def test_extract_gene_name_2():
         amr_obj.logger = logging.getLogger(__name__)
         assert amr_obj.extract_gene_name(protein, reftab) == "aac(2')-IIa"
 
+def test_refgenes_index_resolve():
+    """
+    assert the index resolves a hit to the same drug class and name as the table scan
+    """
+    reftab = pandas.read_csv(REFGENES)
+    reftab = reftab.fillna('-')
+    index = RefGenesIndex(reftab)
+    assert index.resolve('blaSHV-11', 'WP_004176269.1', 'ALLELEX') == ("Beta-lactamase (not ESBL or carbapenemase)", 'blaSHV-11')
+    assert index.resolve('not_a_gene', 'not_an_accession', 'BLASTX') == ("Unknown", 'not_a_gene')
+
+def test_refgenes_index_synonyms():
+    """
+    assert synonyms are indexed individually
+    """
+    reftab = pandas.read_csv(REFGENES)
+    reftab = reftab.fillna('-')
+    index = RefGenesIndex(reftab)
+    assert index.contains('synonyms', 'blaLAT-2')
+    assert index.gene_name('WP_063839881.1') == "aac(2')-IIa"
+
+def test_staged_db(tmp_path):
+    """
+    assert the DB is staged once, shared while in use, restaged if it changes and removed after the last user
+    """
+    source = tmp_path / '2022-08-09.1'
+    source.mkdir()
+    (source / 'version.txt').write_text('2022-08-09.1\n')
+    (source / 'AMRProt').write_text('>prot\nMKV\n')
+    scratch = tmp_path / 'scratch'
+    with StagedDB(source, scratch) as staged:
+        assert '2022-08-09.1' in staged
+        assert (pathlib.Path(staged) / 'AMRProt').read_text() == '>prot\nMKV\n'
+        with StagedDB(source, scratch) as again:
+            assert again == staged
+        assert pathlib.Path(staged).exists()
+        (pathlib.Path(staged) / 'AMRProt').unlink()
+        with StagedDB(source, scratch) as again:
+            assert (pathlib.Path(again) / 'AMRProt').exists()
+    assert not pathlib.Path(staged).exists()
+
+def test_staged_db_failures(tmp_path):
+    """
+    assert a copy that fails part way is removed, and an unversioned DB is staged for this run only
+    """
+    source = tmp_path / 'db'
+    source.mkdir()
+    (source / 'AMRProt').write_text('>prot\nMKV\n')
+    (source / 'AMR.LIB').write_text('hmm\n')
+    scratch = tmp_path / 'scratch'
+    stage = StagedDB(source, scratch)
+    assert f"pid{os.getpid()}" in stage.path.name
+    with patch("abritamr.Stage.os.link", side_effect = OSError), patch("abritamr.Stage.shutil.copy2", side_effect = [None, OSError(28, 'No space left on device')]):
+        with pytest.raises(SystemExit):
+            with stage:
+                pass
+    assert [p.name for p in scratch.iterdir() if p.is_dir()] == []
+    with stage as staged:
+        assert (pathlib.Path(staged) / 'AMRProt').exists()
+
+def test_probe(tmp_path, monkeypatch):
+    """
+    assert tool probes are remembered between processes until the tool changes, and failures are not remembered
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", f"{tmp_path}")
+    calls = []
+    def version():
+        calls.append(1)
+        return '3.10.42'
+    assert probe('version', 'amrfinder:1', version) == '3.10.42'
+    assert probe('version', 'amrfinder:1', version) == '3.10.42'
+    assert len(calls) == 1
+    assert probe('version', 'amrfinder:2', version) == '3.10.42'
+    assert len(calls) == 2
+    assert probe('version', 'amrfinder:3', lambda: '') == ''
+    assert probe('version', 'amrfinder:3', version) == '3.10.42'
+
+def test_load_refgenes_cached(tmp_path, monkeypatch):
+    """
+    assert refgenes is compiled to the cache once and then shared within the process
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", f"{tmp_path}")
+    monkeypatch.setattr(RefGenes, "_LOADED", {})
+    index = load_refgenes(REFGENES)
+    assert len(list((tmp_path / 'abritamr').glob('refgenes_*.pkl'))) == 1
+    assert load_refgenes(REFGENES) is index
+    monkeypatch.setattr(RefGenes, "_LOADED", {})
+    assert load_refgenes(REFGENES).resolve('blaSHV-11', 'WP_004176269.1', 'ALLELEX') == index.resolve('blaSHV-11', 'WP_004176269.1', 'ALLELEX')
+
 def test_setup_dict():
     """
     assert True when non-empty string is given
@@ -491,6 +1246,41 @@ def test_collate():
         assert amr_obj.collate(isolate)[2].equals(virulence)
 
 
+def test_collate_all():
+    """
+    assert the whole batch collation gives the same tables as collating each sample
+    """
+    with patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = Collate()
+        amr_obj.logger = logging.getLogger(__name__)
+        single = amr_obj.collate('tests')
+        batch = amr_obj.collate_all(['tests', 'tests'])
+        for s, b in zip(single, batch):
+            assert list(s.columns) == list(b.columns)
+            assert b.to_dict(orient = 'records') == s.to_dict(orient = 'records') * 2
+
+def test_stream_collate(tmp_path):
+    """
+    assert summaries streamed a block of samples at a time by the vectorised engine are the same as the saved dataframes
+    """
+    with patch.object(Collate, "__init__", lambda x: None):
+        amr_obj = Collate()
+        amr_obj.logger = logging.getLogger(__name__)
+        amr_obj.STREAM_BLOCK = 1
+        (tmp_path / 'stream').mkdir()
+        (tmp_path / 'frames').mkdir()
+        (tmp_path / 'copy').mkdir()
+        shutil.copy(test_folder / 'amrfinder.out', tmp_path / 'copy')
+        prefixes = ['tests', f"{tmp_path / 'copy'}"]
+        with patch.object(Collate, "_classify_hits", autospec = True, side_effect = Collate._classify_hits) as classify:
+            amr_obj.stream_collate(prefixes, path = f"{tmp_path / 'stream'}")
+        assert classify.call_count == 2
+        m, p, v = amr_obj.collate_all(prefixes)
+        amr_obj.save_files(f"{tmp_path / 'frames'}", m, p, v)
+        for f in ['summary_matches.txt', 'summary_partials.txt', 'summary_virulence.txt', 'abritamr.txt']:
+            assert (tmp_path / 'stream' / f).read_text() == (tmp_path / 'frames' / f).read_text()
+        assert list((tmp_path / 'stream').glob('*.spool')) == []
+
 def test_save():
     """
     assert True when non-empty string is given